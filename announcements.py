@@ -0,0 +1,138 @@
+"""
+Merged announcements for +/- reputation replies
+
+When a popular message collects a pile of + replies, announcing each one separately costs a send, a
+bot_service_messages row and later a delete per reply. PointsAnnouncements keeps one open batch per
+(chat_id, target user) instead: the first award in a window is announced with a new message and every later award
+in that window is folded into it, so the chat sees one message like "Y received +14 from 9 people" that is edited
+as awards come in.
+
+Edits are debounced. An award that arrives less than edit_interval after the last edit only marks the batch dirty
+and the caller schedules a single flush for when the interval is up, so a burst of N awards costs one send and a
+handful of edits rather than N sends.
+
+The points themselves are never held back, callers write them to the database straight away. Batches only live in
+memory, after a restart the next award simply starts a new message. pending() lists the ones still waiting on an edit
+so they can be brought up to date before Marvin stops.
+"""
+
+import threading
+import time
+
+
+class Batch:
+    """Awards to one user in one chat that share an announcement"""
+
+    __slots__ = ("chat_id", "user_id", "message_id", "opened", "last_edit", "senders", "gained", "lost", "awards", "total", "boosted", "dirty", "scheduled", "first", "label")
+
+    def __init__(self, chat_id, user_id, opened):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = None
+        self.opened = opened
+        self.last_edit = opened
+        self.senders = set()
+        self.gained = 0
+        self.lost = 0
+        self.awards = 0
+        self.total = 0
+        self.boosted = False
+        self.dirty = False
+        self.scheduled = False
+        # The caller's wording for the first award on its own, and for whoever is receiving in the merged one
+        self.first = None
+        self.label = None
+
+    @property
+    def single(self) -> bool:
+        return self.awards == 1
+
+    def __repr__(self):
+        return f"Batch({self.chat_id}, {self.user_id}, +{self.gained}/-{self.lost} from {len(self.senders)})"
+
+
+class PointsAnnouncements:
+    def __init__(self, window=30, edit_interval=3, clock=time.monotonic):
+        # window: how long after a batch's message is sent later awards still join it
+        # edit_interval: least time between two edits of the same message
+        self.window = window
+        self.edit_interval = edit_interval
+        self.clock = clock
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, user_id, sender_id, delta, total, boosted=False, first=None, label=None):
+        """
+        Folds one award into the batch for (chat_id, user_id). Returns (batch, action) where action is "send" for a
+        new batch that needs its message sent (then call sent()), "edit" when the message should be edited now and
+        "later" when the caller should schedule a flush in delay() seconds, or None when one is already scheduled.
+        """
+        now = self.clock()
+        key = (int(chat_id), int(user_id))
+        with self._lock:
+            self._purge(now)
+            batch = self._batches.get(key)
+            action = "later"
+            if batch is None:
+                batch = Batch(key[0], key[1], now)
+                batch.first = first
+                batch.label = label
+                self._batches[key] = batch
+                action = "send"
+            batch.senders.add(sender_id)
+            if delta >= 0:
+                batch.gained += delta
+            else:
+                batch.lost -= delta
+            batch.awards += 1
+            batch.total = total
+            batch.boosted = batch.boosted or boosted
+            if action != "send":
+                batch.dirty = True
+                if batch.message_id is not None and not batch.scheduled and now - batch.last_edit >= self.edit_interval:
+                    action = "edit"
+                elif batch.scheduled:
+                    # The flush that's already due will pick this one up
+                    action = None
+                else:
+                    batch.scheduled = True
+        return batch, action
+
+    def sent(self, batch, message_id) -> None:
+        with self._lock:
+            batch.message_id = message_id
+            batch.last_edit = self.clock()
+
+    def take(self, batch) -> bool:
+        """Call before editing. Returns False if there's nothing new to show, otherwise marks the batch as shown."""
+        with self._lock:
+            batch.scheduled = False
+            if not batch.dirty or batch.message_id is None:
+                return False
+            batch.dirty = False
+            batch.last_edit = self.clock()
+            return True
+
+    def delay(self, batch) -> float:
+        """Seconds until the batch may be edited again"""
+        return max(0.0, batch.last_edit + self.edit_interval - self.clock())
+
+    def discard(self, batch) -> None:
+        """Stops anything else joining a batch whose message is gone"""
+        with self._lock:
+            key = (batch.chat_id, batch.user_id)
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+
+    def pending(self) -> list:
+        """Batches with changes their message doesn't show yet"""
+        with self._lock:
+            return [batch for batch in self._batches.values() if batch.dirty and batch.message_id is not None]
+
+    def _purge(self, now) -> None:
+        expired = [key for key, batch in self._batches.items() if now - batch.opened >= self.window]
+        for key in expired:
+            del self._batches[key]
+
+    def __len__(self):
+        return len(self._batches)
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark for the /roll dice engine
+
+Compares the old while/randint loop that roll_command used against dice.roll() for a range of roll sizes,
+and times the parser on its own (cold and cached).
+
+Usage:
+- python3 benchmarks/bench_dice.py
+- python3 benchmarks/bench_dice.py --repeat 20
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dice
+
+SIZES = [1, 10, 100, 1000, 10000, 100000]
+EXPRESSIONS = ["1d8", "4d6kh3+2", "2d20adv", "3d8!", "3d6 + 2d4 - 1"]
+
+
+def legacy_roll(totaldice, high):
+    # The original roll_command loop, kept here purely as the baseline
+    low = 1
+    loop = 1
+    rolled = []
+    while loop <= totaldice:
+        loop = loop + 1
+        rolled.append(random.randint(low, high))
+    return str(rolled)
+
+
+def engine_roll(expression, limits):
+    return dice.format_result(dice.roll(expression, limits))
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Best of N runs per measurement")
+    args = parser.parse_args()
+
+    limits = dice.DEFAULT_LIMITS
+    print(f"{'dice':>8} {'legacy ms':>12} {'engine ms':>12} {'speedup':>9}")
+    for size in SIZES:
+        legacy = best_of(lambda: legacy_roll(size, 6), args.repeat)
+        engine = best_of(lambda: engine_roll(f"{size}d6", limits), args.repeat)
+        print(f"{size:>8} {legacy * 1000:>12.3f} {engine * 1000:>12.3f} {legacy / engine:>8.1f}x")
+
+    print()
+    print(f"{'expression':<16} {'parse us':>10} {'cached us':>10} {'roll us':>10}")
+    for expression in EXPRESSIONS:
+        def cold():
+            dice.parse.cache_clear()
+            dice.parse(expression)
+        cold_time = best_of(cold, args.repeat * 20)
+        dice.parse(expression)
+        cached_time = best_of(lambda: dice.parse(expression), args.repeat * 20)
+        roll_time = best_of(lambda: engine_roll(expression, limits), args.repeat * 20)
+        print(f"{expression:<16} {cold_time * 1e6:>10.1f} {cached_time * 1e6:>10.1f} {roll_time * 1e6:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Sharded mode throughput benchmark
+
+Runs the same synthetic traffic (see loadgen.py) through sharding.Router with 1, 2, 4... worker processes and
+reports updates/sec for each shard count. Every worker builds its own throwaway database holding only the chats
+it owns and answers the Bot API with a FakeBot, so this measures the routing and the workers, not Telegram.
+
+A real Bot API call takes tens of milliseconds, which is time a single process spends waiting. --api-latency
+simulates that; with it at 0 the workers only compete for CPU and scaling is capped by the cores available.
+
+Usage:
+- python3 benchmarks/bench_shards.py
+- python3 benchmarks/bench_shards.py --shards 1 2 4 8 --chats 200 --updates 5000 --api-latency 0.02
+- python3 benchmarks/bench_shards.py --json shards.json
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import sharding
+from loadgen import DEFAULT_MIX, plan_population, generate_traffic
+
+
+def bench_worker(shard, shards, inbox, outbox, base, options) -> None:
+    """Worker process: fills this shard's chats into a fresh database, then serves like sharding.worker_main"""
+    sys.path.insert(0, BENCHMARK_DIR)
+    import contextlib
+    from fakebot import FakeBot
+    from loadgen import fill_database
+    from replay import prepare_workspace, load_marvin, build_dispatcher
+
+    # Each worker gets its own directory, MarvinBot reads and writes its working directory
+    prepare_workspace(os.path.join(base, f"{shards}-shards", str(shard)))
+    random.seed(options["seed"] + shard)
+    marvin = load_marvin()
+    bot = FakeBot(latency=options["api_latency"])
+    fill_database(marvin, bot, random.Random(options["seed"] + shard), options["chats"], options["users"], options["triggers"], options["terms"], options["points_share"],
+                  owns=lambda chat_id: sharding.shard_for(chat_id, shards) == shard)
+    dispatcher = build_dispatcher(marvin, bot)
+    # Marvin prints as well as logs, keep the benchmark output readable
+    with open(os.devnull, "w") as output, contextlib.redirect_stdout(output):
+        sharding.serve(dispatcher, inbox, outbox, shard, {})
+
+
+def run_shards(shards, updates, options, base) -> dict:
+    router = sharding.Router(shards, target=bench_worker, args=(base, options))
+
+    start = time.perf_counter()
+    router.start()
+    # Nothing is answered until a worker has filled its database, so this doubles as the ready barrier
+    if None in router.collect("handled", timeout=600):
+        router.stop()
+        raise SystemExit(f"Workers didn't start with {shards} shards")
+    ready = time.perf_counter() - start
+
+    per_shard = [0] * shards
+    start = time.perf_counter()
+    for update in updates:
+        shard = sharding.shard_for(update["message"]["chat"]["id"], shards)
+        per_shard[shard] += 1
+        router.forward_json(shard, update)
+    # Queues are FIFO, so every update has been processed by the time each shard answers
+    handled = router.collect("handled", timeout=3600)
+    elapsed = time.perf_counter() - start
+    router.stop()
+
+    return {
+        "shards": shards,
+        "updates": sum(count or 0 for count in handled),
+        "elapsed_s": elapsed,
+        "updates_per_s": len(updates) / elapsed if elapsed else 0.0,
+        "per_shard": per_shard,
+        "startup_s": ready,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4], help="Shard counts to compare")
+    parser.add_argument("--chats", type=int, default=64, help="Number of chats, spread over the shards")
+    parser.add_argument("--users", type=int, default=30, help="Users per chat")
+    parser.add_argument("--triggers", type=int, default=10, help="Triggers per chat")
+    parser.add_argument("--terms", type=int, default=3, help="Closed terms of points history per chat")
+    parser.add_argument("--points-share", type=float, default=0.6, help="Share of users holding points in each term")
+    parser.add_argument("--updates", type=int, default=2000, help="Number of updates to drive per shard count")
+    parser.add_argument("--api-latency", type=float, default=0.005, help="Seconds of simulated latency per Bot API call")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workspace", help="Directory for the shard databases (default: a new temporary directory, removed afterwards)")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    os.environ.setdefault("TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("TERMLENGTH", "7")
+    options = {
+        "chats": args.chats, "users": args.users, "triggers": args.triggers, "terms": args.terms,
+        "points_share": args.points_share, "api_latency": args.api_latency, "seed": args.seed,
+    }
+    # The same traffic for every shard count
+    updates = generate_traffic(plan_population(args.chats, args.users, args.triggers), random.Random(args.seed), args.updates, DEFAULT_MIX)
+
+    base = args.workspace or tempfile.mkdtemp(prefix="marvin-shards-")
+    results = []
+    try:
+        for shards in args.shards:
+            result = run_shards(shards, updates, options, base)
+            results.append(result)
+            print(f"{shards} shard(s): {result['updates_per_s']:.1f} updates/s, {result['elapsed_s']:.2f}s for {result['updates']} updates "
+                  f"(per shard {result['per_shard']}, startup {result['startup_s']:.1f}s)")
+    finally:
+        if not args.workspace:
+            shutil.rmtree(base, ignore_errors=True)
+
+    baseline = results[0]["updates_per_s"] if results else 0
+    print(f"\nCPUs: {os.cpu_count()}, API latency {args.api_latency * 1000:.0f}ms per call")
+    print(f"{'shards':>6} {'updates/s':>10} {'speedup':>8}")
+    for result in results:
+        speedup = result["updates_per_s"] / baseline if baseline else 0
+        print(f"{result['shards']:>6} {result['updates_per_s']:>10.1f} {speedup:>7.2f}x")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf8") as handle:
+            json.dump(results, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
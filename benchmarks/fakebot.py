@@ -0,0 +1,110 @@
+"""
+In-process stand-in for telegram.Bot used by the offline benchmarks
+
+FakeBot subclasses the real Bot and only replaces _post(), so every Bot method Marvin calls still goes
+through python-telegram-bot's own argument handling and de_json parsing. Nothing leaves the process:
+each call is recorded and answered with a canned payload (Message, ChatMember, StickerSet etc).
+"""
+
+import itertools
+import threading
+import time
+from collections import Counter
+
+from telegram import Bot
+
+BOT_USER = {'id': 424242, 'is_bot': True, 'first_name': 'Marvin', 'username': 'MarvinBenchBot'}
+
+# Emojis hp_random_character() looks for in each sticker set
+STICKER_SETS = {
+    'BoyWhoLived': ['✊️', '😒', '😜', '👍', '🔮', '😁', '😉', '😎', '🖕'],
+    'PotterAdditional': ['👾'],
+    'Lord_Voldemort': ['😂'],
+}
+
+MESSAGE_ENDPOINTS = ('sendMessage', 'sendSticker', 'sendAnimation', 'sendPhoto', 'editMessageText')
+
+
+class FakeBot(Bot):
+    """A Bot whose API calls are recorded rather than sent. Thread safe so it can sit behind worker threads."""
+
+    def __init__(self, token='123456:BENCHMARK', latency=0.0):
+        super().__init__(token)
+        self.latency = latency
+        self.calls = Counter()
+        self.call_log = []
+        self.record_log = False
+        self.members = {}
+        self.users = {}
+        self._message_ids = itertools.count(1000000)
+        self._lock = threading.Lock()
+
+    def add_user(self, user_id, first_name, username=None, last_name=None):
+        """Registers a user so get_chat_member can answer with their real details"""
+        user = {'id': int(user_id), 'is_bot': False, 'first_name': first_name}
+        if username:
+            user['username'] = username
+        if last_name:
+            user['last_name'] = last_name
+        self.users[int(user_id)] = user
+
+    def set_member_status(self, chat_id, user_id, status):
+        self.members[(int(chat_id), int(user_id))] = status
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.call_log = []
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        data = dict(data or {})
+        if api_kwargs:
+            data.update(api_kwargs)
+        with self._lock:
+            self.calls[endpoint] += 1
+            if self.record_log:
+                self.call_log.append((endpoint, data))
+        if self.latency:
+            # Simulated network round trip
+            time.sleep(self.latency)
+        return self._respond(endpoint, data)
+
+    def _respond(self, endpoint, data):
+        if endpoint == 'getMe':
+            return dict(BOT_USER)
+        if endpoint == 'getChatMember':
+            chat_id, user_id = int(data['chat_id']), int(data['user_id'])
+            if user_id == BOT_USER['id']:
+                return {'status': 'administrator', 'user': dict(BOT_USER), 'can_be_edited': False,
+                        'is_anonymous': False, 'can_manage_chat': True, 'can_delete_messages': True,
+                        'can_manage_voice_chats': True, 'can_restrict_members': True,
+                        'can_promote_members': False, 'can_change_info': True, 'can_invite_users': True}
+            status = self.members.get((chat_id, user_id), 'member')
+            user = self.users.get(user_id, {'id': user_id, 'is_bot': False, 'first_name': 'User' + str(user_id)})
+            member = {'status': status, 'user': dict(user)}
+            if status == 'creator':
+                member['is_anonymous'] = False
+            return member
+        if endpoint in MESSAGE_ENDPOINTS:
+            message_id = int(data['message_id']) if endpoint == 'editMessageText' else next(self._message_ids)
+            message = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(data['chat_id']), 'type': 'supergroup', 'title': 'Benchmark'},
+                'from': dict(BOT_USER),
+            }
+            if 'text' in data:
+                message['text'] = data['text']
+            return message
+        if endpoint == 'getStickerSet':
+            emojis = STICKER_SETS.get(data['name'], [])
+            stickers = [{'file_id': data['name'] + str(index), 'file_unique_id': data['name'] + str(index),
+                         'width': 512, 'height': 512, 'is_animated': False, 'is_video': False,
+                         'type': 'regular', 'emoji': emoji} for index, emoji in enumerate(emojis)]
+            return {'name': data['name'], 'title': data['name'], 'is_animated': False,
+                    'contains_masks': False, 'is_video': False, 'stickers': stickers}
+        # deleteMessage, pinChatMessage, answerCallbackQuery and friends
+        return True
@@ -0,0 +1,322 @@
+"""
+Synthetic multi-chat load generator for the reputation and trigger subsystems
+
+Fills a fresh marvin.db with N chats, M users per chat, K triggers per chat and a points history spanning
+several terms, then drives a realistic message mix (chatter, +/- replies, /points, /activity, trigger hits)
+through the real dispatcher at a target rate and reports where the time went.
+
+Everything is driven from --seed (the fill, the traffic and Marvin's own random choices), so two runs with
+the same arguments are directly comparable across code changes.
+
+Usage:
+- python3 benchmarks/loadgen.py --chats 200 --users 50 --triggers 20 --updates 5000
+- python3 benchmarks/loadgen.py --chats 200 --users 50 --rate 100 --duration 30
+- python3 benchmarks/loadgen.py --chats 50 --mix chatter=50,plus=30,points=20 --profile
+- python3 benchmarks/loadgen.py --chats 200 --users 50 --updates 5000 --sql-profile
+- python3 benchmarks/loadgen.py --chats 200 --users 50 --updates 5000 --storage :memory:
+- python3 benchmarks/loadgen.py --chats 200 --users 50 --updates 5000 --warm-start
+- python3 benchmarks/loadgen.py --chats 500 --users 100 --fill-only --workspace ./bigdb
+"""
+
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update
+
+from fakebot import FakeBot
+from replay import prepare_workspace, load_marvin, build_dispatcher, ReplayStats, make_message, print_report, print_sql_profile
+
+HOUSES = ["Gryffindor", "Slytherin", "Hufflepuff", "Ravenclaw", "Houseelf", None]
+
+DEFAULT_MIX = {
+    'chatter': 70,
+    'plus': 10,
+    'minus': 3,
+    'points': 4,
+    'activity': 2,
+    'trigger': 11,
+}
+
+# pstats entries grouped into the buckets the report breaks time down by
+TIME_BUCKETS = (
+    ("SQLite", ("sqlite3.Cursor", "sqlite3.Connection")),
+    ("Bot API (fake)", ("fakebot.py",)),
+    ("PTB parsing", ("telegram/",)),
+)
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        mix = {}
+        for part in text.split(","):
+            name, _, weight = part.partition("=")
+            if name.strip() not in DEFAULT_MIX:
+                raise SystemExit("Unknown message kind '" + name.strip() + "', options are: " + ", ".join(DEFAULT_MIX))
+            mix[name.strip()] = float(weight)
+    return mix
+
+
+class Population:
+    """The chats, users and triggers the fill created, kept so the traffic can target them"""
+
+    def __init__(self):
+        self.chats = []
+        self.users = {}
+        self.triggers = {}
+        self.message_ids = {}
+        self.recent = {}
+
+
+def plan_population(chats, users, triggers) -> Population:
+    """The chat, user and trigger ids a fill of this size creates, without touching a database"""
+    population = Population()
+    for chat_index in range(chats):
+        chat_id = -1002000000000 - chat_index
+        population.chats.append(chat_id)
+        population.users[chat_id] = [5000000 + chat_index * users + user_index for user_index in range(users)]
+        population.triggers[chat_id] = ["trigger" + str(index) for index in range(triggers)]
+        population.message_ids[chat_id] = 1
+        population.recent[chat_id] = []
+    return population
+
+
+def fill_database(marvin, bot, rng, chats, users, triggers, terms, points_share, owns=None) -> Population:
+    """
+    Bulk loads chats, users, triggers and a points history straight into the database. With owns, only the chats it
+    returns True for are written (a shard's share), the population still lists all of them. Goes through the storage
+    engine, so a --storage of postgresql://... is filled too (its tables have to start out empty).
+    """
+    db = marvin.store.engine
+    population = plan_population(chats, users, triggers)
+    # Epoch seconds, like every time column
+    now = int(time.time())
+    term_length = int(marvin.TERMLENGTH) * 86400
+
+    for chat_id in population.chats:
+        if owns is not None and not owns(chat_id):
+            continue
+        marvin.db_initialise(chat_id)
+
+        user_rows = []
+        chat_users = population.users[chat_id]
+        for user_id in chat_users:
+            username = "user" + str(user_id)
+            last_seen = now - rng.randint(0, 30 * 86400)
+            user_rows.append((user_id, chat_id, last_seen, last_seen, "member", rng.choice(HOUSES), username, username.lower()))
+            bot.add_user(user_id, "Pupil" + str(user_id), username)
+        db.executemany("INSERT INTO users (user_id,chat_id,timestamp,last_seen,status,hp_house,username,username_norm) VALUES(?,?,?,?,?,?,?,?)", user_rows)
+
+        trigger_words = population.triggers[chat_id]
+        trigger_rows = [(word, "Response for " + word + " " + "x" * rng.randint(10, 400), chat_id, "text", "None") for word in trigger_words]
+        db.executemany("INSERT INTO triggers (trigger_word,trigger_response,chat_id,trigger_response_type,trigger_response_media_id) VALUES(?,?,?,?,?)", trigger_rows)
+
+        # Closed terms first, then the current one which ends a term length from now
+        term_rows = []
+        point_rows = []
+        for term_index in range(terms + 1):
+            is_current = 1 if term_index == terms else 0
+            end = now + term_length - term_length * (terms - term_index)
+            start = end - term_length
+            term_id = str(uuid.UUID(int=rng.getrandbits(128)))
+            term_rows.append((chat_id, term_id, start, end, is_current))
+            for user_id in chat_users:
+                if rng.random() < points_share:
+                    point_rows.append((user_id, chat_id, rng.randint(-20, 200), start, term_id))
+        db.executemany("INSERT INTO hp_terms (chat_id, term_id, start_date, end_date, is_current) VALUES(?,?,?,?,?)", term_rows)
+        db.executemany("INSERT INTO hp_points (user_id, chat_id, points, timestamp, term_id) VALUES(?,?,?,?,?)", point_rows)
+        # Each total gets a matching ledger entry, as if it had been awarded in one go
+        db.executemany("INSERT INTO hp_points_ledger (chat_id, term_id, user_id, delta, reason, created) VALUES(?,?,?,?,'opening_balance',?)", [(row[1], row[4], row[0], row[2], row[3]) for row in point_rows])
+
+    marvin.store.commit()
+    # Written behind the repositories' backs, so nothing they cached is current any more
+    marvin.store.cache.clear()
+    return population
+
+
+def generate_traffic(population, rng, count, mix):
+    """Builds count Update dicts following the weighted mix"""
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    updates = []
+
+    def message(chat_id, user_id, text, reply_to=None):
+        message_id = population.message_ids[chat_id]
+        population.message_ids[chat_id] += 1
+        user = {'id': user_id, 'is_bot': False, 'first_name': 'Pupil' + str(user_id), 'username': 'user' + str(user_id)}
+        data = make_message(message_id, chat_id, user, text, reply_to)
+        if reply_to is None and not text.startswith('/'):
+            recent = population.recent[chat_id]
+            recent.append(data)
+            del recent[:-20]
+        updates.append({'update_id': len(updates) + 1, 'message': data})
+
+    while len(updates) < count:
+        chat_id = rng.choice(population.chats)
+        user_id = rng.choice(population.users[chat_id])
+        kind = rng.choices(kinds, weights)[0]
+        if kind in ('plus', 'minus'):
+            targets = [data for data in population.recent[chat_id] if data['from']['id'] != user_id]
+            if not targets:
+                kind = 'chatter'
+            else:
+                message(chat_id, user_id, rng.choice(["+", "+1 great point"]) if kind == 'plus' else "-", rng.choice(targets))
+                continue
+        if kind == 'points':
+            message(chat_id, user_id, rng.choice(["/points", "/points totals"]))
+        elif kind == 'activity':
+            message(chat_id, user_id, rng.choice(["/activity", "/activity full"]))
+        elif kind == 'trigger' and population.triggers[chat_id]:
+            message(chat_id, user_id, rng.choice(population.triggers[chat_id]))
+        else:
+            message(chat_id, user_id, rng.choice(["morning all", "anyone around?", "ha", "that's brilliant", "brb", "did you see that?"]))
+    return updates
+
+
+def drive(dispatcher, stats, updates, bot, rate, quiet):
+    """Pushes updates through the dispatcher, pacing to rate updates/sec when rate > 0. Returns (elapsed, max lag)."""
+    parsed = [Update.de_json(data, bot) for data in updates]
+    interval = 1.0 / rate if rate else 0.0
+    max_lag = 0.0
+    if not quiet:
+        logging.getLogger().setLevel(logging.INFO)
+    output = open(os.devnull, "w") if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        start = time.perf_counter()
+        for index, update in enumerate(parsed):
+            if interval:
+                due = start + index * interval
+                now = time.perf_counter()
+                if now < due:
+                    time.sleep(due - now)
+                else:
+                    max_lag = max(max_lag, now - due)
+            stats.process(dispatcher, update)
+        elapsed = time.perf_counter() - start
+    if output:
+        output.close()
+    return elapsed, max_lag
+
+
+def time_breakdown(profile, total):
+    """Splits profiled time into SQLite, Bot API, PTB parsing and everything else (Marvin's own Python)"""
+    stats = pstats.Stats(profile)
+    buckets = {name: 0.0 for name, _ in TIME_BUCKETS}
+    for (filename, _, function), (_, _, own_time, _, _) in stats.stats.items():
+        label = filename + " " + function
+        for name, markers in TIME_BUCKETS:
+            if any(marker in label for marker in markers):
+                buckets[name] += own_time
+                break
+    buckets["Marvin / other"] = max(total - sum(buckets.values()), 0.0)
+    return buckets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=100, help="Number of chats to create")
+    parser.add_argument("--users", type=int, default=50, help="Users per chat")
+    parser.add_argument("--triggers", type=int, default=20, help="Triggers per chat")
+    parser.add_argument("--terms", type=int, default=5, help="Closed terms of points history per chat")
+    parser.add_argument("--points-share", type=float, default=0.6, help="Share of users holding points in each term")
+    parser.add_argument("--updates", type=int, default=2000, help="Number of updates to drive (ignored with --duration)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Target updates/sec, 0 runs flat out")
+    parser.add_argument("--duration", type=float, help="Seconds to run at --rate, sets the update count")
+    parser.add_argument("--mix", help="Weighted mix e.g. chatter=70,plus=10,minus=3,points=4,activity=2,trigger=11")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds of simulated latency per Bot API call")
+    parser.add_argument("--profile", action="store_true", help="Run under cProfile and break time down by subsystem")
+    parser.add_argument("--sql-profile", action="store_true", help="Profile every statement and print the worst with query plans")
+    parser.add_argument("--workspace", help="Directory to build the database in (default: a new temporary directory)")
+    parser.add_argument("--storage", help="STORAGE_URL for Marvin, :memory: keeps the database off the disk, a postgresql:// one needs empty tables (see storage.py)")
+    parser.add_argument("--warm-start", action="store_true", help="Preload the recently active chats before driving traffic, like main() does")
+    parser.add_argument("--fill-only", action="store_true", help="Build the database and stop")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Let Marvin's console output through")
+    args = parser.parse_args()
+
+    if args.duration and not args.rate:
+        parser.error("--duration needs a --rate")
+    count = int(args.rate * args.duration) if args.duration else args.updates
+    mix = parse_mix(args.mix)
+    if args.sql_profile:
+        os.environ["SQL_PROFILE"] = "True"
+    if args.storage is not None:
+        os.environ["STORAGE_URL"] = args.storage
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    workspace = prepare_workspace(args.workspace)
+    if os.path.exists("marvin.db"):
+        raise SystemExit("Workspace " + workspace + " already has a marvin.db, the load generator needs a fresh one.")
+
+    # One seed drives the fill, the traffic and Marvin's own random picks
+    random.seed(args.seed)
+    rng = random.Random(args.seed)
+
+    marvin = load_marvin()
+    bot = FakeBot(latency=args.api_latency)
+
+    fill_start = time.perf_counter()
+    population = fill_database(marvin, bot, rng, args.chats, args.users, args.triggers, args.terms, args.points_share)
+    fill_time = time.perf_counter() - fill_start
+    # Pages in use rather than the file, so it works for :memory: too
+    size = marvin.db.execute("PRAGMA page_count").fetchone()[0] * marvin.db.execute("PRAGMA page_size").fetchone()[0]
+    print(f"Filled {args.chats} chats x {args.users} users, {args.triggers} triggers, {args.terms + 1} terms in {fill_time:.2f}s ({size / 1048576:.1f} MiB) at {workspace}")
+    if args.fill_only:
+        return
+    if args.warm_start:
+        marvin.warm_start(bot, budget=60)
+
+    updates = generate_traffic(population, rng, count, mix)
+    dispatcher = build_dispatcher(marvin, bot)
+    stats = ReplayStats(marvin, bot)
+    stats.instrument(dispatcher)
+
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    elapsed, max_lag = drive(dispatcher, stats, updates, bot, args.rate, not args.verbose)
+    if profile:
+        profile.disable()
+    marvin.db.set_trace_callback(None)
+    marvin.store.engine.set_trace_callback(None)
+
+    summary = stats.summary(elapsed)
+    summary.update({"workspace": workspace, "seed": args.seed, "target_rate": args.rate, "max_lag_s": max_lag, "fill_s": fill_time, "db_bytes": size})
+    print_report(summary)
+    if args.rate:
+        print(f"\nTarget rate {args.rate:.1f}/s, achieved {summary['updates_per_s']:.1f}/s, worst lag behind schedule {max_lag * 1000:.1f}ms")
+
+    print_sql_profile(marvin)
+
+    if profile:
+        busy = sum(stats.update_latencies)
+        breakdown = time_breakdown(profile, busy)
+        summary["time_breakdown_s"] = breakdown
+        print("\nWhere the time went:")
+        for name, seconds in sorted(breakdown.items(), key=lambda item: item[1], reverse=True):
+            print(f"  {name:<18} {seconds:>8.2f}s {100 * seconds / busy if busy else 0:>6.1f}%")
+        print("\nTop functions by own time:")
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("tottime").print_stats(15)
+        print("\n".join(line for line in output.getvalue().splitlines() if line.strip()))
+
+    if json_path:
+        with open(json_path, "w", encoding="utf8") as handle:
+            json.dump(summary, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+"""
+Offline update replay benchmark
+
+Replays recorded or synthetic Telegram Update JSON through the real handlers registered by
+MarvinBot.register_handlers(), with a FakeBot standing in for the Telegram API. Runs entirely offline
+against a throwaway marvin.db in a scratch directory, so no token or network is required.
+
+Reports updates/sec plus, per handler: p50/p99 latency, errors, SQL statements and Bot API calls.
+
+Usage:
+- python3 benchmarks/replay.py --synthetic 2000
+- python3 benchmarks/replay.py --synthetic 2000 --record updates.jsonl
+- python3 benchmarks/replay.py --updates updates.jsonl --database copy_of_marvin.db
+- python3 benchmarks/replay.py --synthetic 2000 --json results.json
+- python3 benchmarks/replay.py --synthetic 2000 --sql-profile
+
+Recorded updates are one Update per line, exactly as returned by the Bot API getUpdates call.
+"""
+
+import argparse
+import contextlib
+import functools
+import importlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from queue import Queue
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from fakebot import FakeBot, BOT_USER
+
+
+def prepare_workspace(path=None, database=None) -> str:
+    """Creates a scratch directory holding everything MarvinBot reads from its working directory, and moves into it"""
+    path = path or tempfile.mkdtemp(prefix="marvin-bench-")
+    os.makedirs(path, exist_ok=True)
+    for example, target in (("rollSass.json.example", "rollSass.json"), ("Sass.json.example", "Sass.json"), ("helpText.txt", "helpText.txt")):
+        if not os.path.exists(os.path.join(path, target)):
+            shutil.copy(os.path.join(REPO_DIR, example), os.path.join(path, target))
+    if database:
+        shutil.copy(database, os.path.join(path, "marvin.db"))
+    os.chdir(path)
+
+    # MarvinBot reads these through python-decouple at import time
+    os.environ.setdefault("TOKEN", "123456:BENCHMARK")
+    os.environ.setdefault("TERMLENGTH", "7")
+    return path
+
+
+def load_marvin():
+    """Imports MarvinBot from the workspace. Must be called after prepare_workspace() as the database opens on import."""
+    marvin = importlib.import_module("MarvinBot")
+    # Benchmarks only care about errors, not the per-message INFO chatter
+    logging.getLogger().setLevel(logging.ERROR)
+    return marvin
+
+
+def print_sql_profile(marvin, limit=10) -> None:
+    """Prints the profiler's most expensive statements and their query plans, when SQL_PROFILE was on"""
+    if marvin.sql_profiler is None:
+        return
+    print("\nMost expensive statements:")
+    print(marvin.sql_profiler.report(limit))
+    print("\nQuery plans:")
+    print(marvin.sql_profiler.explain_report(marvin.db, limit // 2))
+
+
+def build_dispatcher(marvin, bot):
+    dispatcher = Dispatcher(bot, Queue(), workers=1)
+    marvin.register_handlers(dispatcher)
+    return dispatcher
+
+
+class ReplayStats:
+    """Wraps every registered handler to time it and attribute SQL statements and Bot API calls to it"""
+
+    def __init__(self, marvin, bot):
+        self.marvin = marvin
+        self.bot = bot
+        self.current = None
+        self.sql_statements = Counter()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.api_calls = Counter()
+        self.api_endpoints = defaultdict(Counter)
+        self.update_latencies = []
+        self.update_sql = []
+        self.update_api = []
+        self._update_sql = 0
+
+    def instrument(self, dispatcher) -> None:
+        for group in dispatcher.groups:
+            for handler in dispatcher.handlers[group]:
+                handler.callback = self._wrap(handler.callback)
+        # Every statement on the shared connection, including the ones run through the global cursor. Safe here as
+        # updates are replayed on this one thread with no jobs running.
+        self.marvin.db.set_trace_callback(self._trace)
+        # Plus the repositories' when they're somewhere else (PostgreSQL, :memory:)
+        if getattr(self.marvin.store.engine, "connection", None) is not self.marvin.db:
+            self.marvin.store.engine.set_trace_callback(self._trace)
+
+    def _trace(self, statement) -> None:
+        self._update_sql += 1
+        if self.current is not None:
+            self.sql_statements[self.current] += 1
+
+    def _wrap(self, callback):
+        name = callback.__name__
+
+        @functools.wraps(callback)
+        def timed(update, context):
+            self.current = name
+            api_before = self.bot.calls.copy()
+            start = time.perf_counter()
+            try:
+                return callback(update, context)
+            except Exception:
+                self.errors[name] += 1
+                raise
+            finally:
+                self.latencies[name].append(time.perf_counter() - start)
+                made = self.bot.calls - api_before
+                self.api_calls[name] += sum(made.values())
+                self.api_endpoints[name].update(made)
+                self.current = None
+        return timed
+
+    def process(self, dispatcher, update) -> None:
+        self._update_sql = 0
+        api_before = self.bot.total_calls()
+        start = time.perf_counter()
+        dispatcher.process_update(update)
+        self.update_latencies.append(time.perf_counter() - start)
+        self.update_sql.append(self._update_sql)
+        self.update_api.append(self.bot.total_calls() - api_before)
+
+    def summary(self, elapsed) -> dict:
+        updates = len(self.update_latencies)
+        handlers = {}
+        for name, values in sorted(self.latencies.items()):
+            calls = len(values)
+            handlers[name] = {
+                "calls": calls,
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+                "total_ms": sum(values) * 1000,
+                "errors": self.errors[name],
+                "sql_per_call": self.sql_statements[name] / calls,
+                "api_per_call": self.api_calls[name] / calls,
+                "api_endpoints": dict(self.api_endpoints[name]),
+            }
+        return {
+            "updates": updates,
+            "elapsed_s": elapsed,
+            "updates_per_s": updates / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(self.update_latencies, 0.50) * 1000,
+            "p99_ms": percentile(self.update_latencies, 0.99) * 1000,
+            "sql_per_update": sum(self.update_sql) / updates if updates else 0.0,
+            "api_per_update": sum(self.update_api) / updates if updates else 0.0,
+            "handlers": handlers,
+            # chat_polling's stages, see pipeline.py
+            "stages": {pipeline + "." + stage: {"calls": calls, "mean_ms": mean_ms, "p99_ms": p99_ms}
+                       for pipeline, stage, calls, mean_ms, p99_ms in self.marvin.metrics.stage_report()},
+        }
+
+
+def percentile(values, fraction) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def print_report(summary) -> None:
+    print(f"Updates: {summary['updates']}  Elapsed: {summary['elapsed_s']:.2f}s  Throughput: {summary['updates_per_s']:.1f} updates/s")
+    print(f"Per update: p50 {summary['p50_ms']:.2f}ms  p99 {summary['p99_ms']:.2f}ms  SQL {summary['sql_per_update']:.1f}  API {summary['api_per_update']:.2f}")
+    print()
+    print(f"{'handler':<28} {'calls':>7} {'p50 ms':>9} {'p99 ms':>9} {'total ms':>10} {'errors':>7} {'SQL/call':>9} {'API/call':>9}")
+    for name, row in sorted(summary["handlers"].items(), key=lambda item: item[1]["total_ms"], reverse=True):
+        print(f"{name:<28} {row['calls']:>7} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['total_ms']:>10.1f} {row['errors']:>7} {row['sql_per_call']:>9.1f} {row['api_per_call']:>9.2f}")
+    if summary.get("stages"):
+        print()
+        print(f"{'stage':<28} {'calls':>7} {'mean ms':>9} {'p99 ms':>9}")
+        for name, row in summary["stages"].items():
+            print(f"{name:<28} {row['calls']:>7} {row['mean_ms']:>9.3f} {row['p99_ms']:>9.2f}")
+
+
+# Synthetic traffic
+# A repeatable mix of ordinary chatter, reputation replies, trigger hits and commands across a handful of chats
+
+def make_user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': 'Pupil' + str(user_id), 'username': 'pupil' + str(user_id)}
+
+
+def make_message(message_id, chat_id, user, text, reply_to=None, date=None):
+    message = {
+        'message_id': message_id,
+        'date': date or int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'Chat ' + str(chat_id)},
+        'from': user,
+        'text': text,
+    }
+    if text.startswith('/'):
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    if reply_to is not None:
+        message['reply_to_message'] = reply_to
+    return message
+
+
+class SyntheticChat:
+    """Tracks message ids and recent messages for one chat so replies point at real earlier messages"""
+
+    def __init__(self, chat_id, user_ids, triggers):
+        self.chat_id = chat_id
+        self.user_ids = user_ids
+        self.triggers = triggers
+        self.next_message_id = 1
+        self.recent = []
+
+    def message(self, user_id, text, reply_to=None):
+        message = make_message(self.next_message_id, self.chat_id, make_user(user_id), text, reply_to)
+        self.next_message_id += 1
+        stored = dict(message)
+        stored.pop('reply_to_message', None)
+        self.recent.append(stored)
+        del self.recent[:-20]
+        return message
+
+
+DEFAULT_MIX = {
+    'chatter': 70,
+    'reputation_plus': 8,
+    'reputation_minus': 3,
+    'trigger': 5,
+    'roll': 4,
+    'points': 3,
+    'activity': 2,
+    'list': 2,
+    'reply_bot': 3,
+}
+
+
+def synthetic_updates(count, chats=5, users=20, triggers=5, seed=1, mix=None):
+    """Builds a repeatable list of Update dicts. Each chat is primed with chatter and triggers before the mix starts,
+    so the result can be slightly longer than count for tiny runs."""
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    updates = []
+    update_id = 1
+
+    chat_states = []
+    for chat_index in range(chats):
+        chat_id = -1001000000000 - chat_index
+        user_ids = [100000 + chat_index * users + index for index in range(users)]
+        chat_states.append(SyntheticChat(chat_id, user_ids, ['trigger' + str(index) for index in range(triggers)]))
+
+    def add(message):
+        nonlocal update_id
+        updates.append({'update_id': update_id, 'message': message})
+        update_id += 1
+
+    # Every chat needs at least one message before commands make sense (creates tables, config, first term)
+    for chat in chat_states:
+        for user_id in chat.user_ids:
+            add(chat.message(user_id, "Hello from " + str(user_id)))
+        for trigger in chat.triggers:
+            add(chat.message(chat.user_ids[0], "/add " + trigger + " -> a response for " + trigger))
+
+    while len(updates) < count:
+        chat = rng.choice(chat_states)
+        user_id = rng.choice(chat.user_ids)
+        kind = rng.choices(kinds, weights)[0]
+        if kind in ('reputation_plus', 'reputation_minus'):
+            targets = [message for message in chat.recent if message['from']['id'] != user_id and not message['from']['is_bot']]
+            if not targets:
+                continue
+            add(chat.message(user_id, '+' if kind == 'reputation_plus' else '-', rng.choice(targets)))
+        elif kind == 'trigger':
+            add(chat.message(user_id, rng.choice(chat.triggers)))
+        elif kind == 'roll':
+            add(chat.message(user_id, "/roll " + rng.choice(["2d6", "4d6kh3+2", "1d20", "2d20adv"])))
+        elif kind == 'points':
+            add(chat.message(user_id, rng.choice(["/points", "/points totals"])))
+        elif kind == 'activity':
+            add(chat.message(user_id, rng.choice(["/activity", "/activity full"])))
+        elif kind == 'list':
+            add(chat.message(user_id, "/list"))
+        elif kind == 'reply_bot':
+            bot_message = make_message(rng.randint(1, chat.next_message_id), chat.chat_id, dict(BOT_USER), "Quick! The Golden Snitch just flew past your head!")
+            add(chat.message(user_id, rng.choice(["Caught it!", "nice one marvin"]), bot_message))
+        else:
+            add(chat.message(user_id, rng.choice(["morning all", "anyone watching the match?", "lol", "that's brilliant", "brb"])))
+
+    return updates
+
+
+def load_updates(path):
+    with open(path, encoding="utf8") as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+
+def register_users(bot, updates) -> None:
+    # Give the fake API the same names the updates carry so get_chat_member answers consistently
+    for data in updates:
+        message = data.get('message') or data.get('edited_message') or {}
+        for candidate in (message.get('from'), (message.get('reply_to_message') or {}).get('from')):
+            if candidate and not candidate.get('is_bot'):
+                bot.add_user(candidate['id'], candidate.get('first_name', ''), candidate.get('username'), candidate.get('last_name'))
+
+
+def run(updates, bot, marvin, quiet=True):
+    """Replays updates through a fresh dispatcher and returns the summary dict"""
+    dispatcher = build_dispatcher(marvin, bot)
+    stats = ReplayStats(marvin, bot)
+    stats.instrument(dispatcher)
+    register_users(bot, updates)
+    parsed = [Update.de_json(data, bot) for data in updates]
+
+    if not quiet:
+        logging.getLogger().setLevel(logging.INFO)
+    output = open(os.devnull, "w") if quiet else None
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        start = time.perf_counter()
+        for update in parsed:
+            stats.process(dispatcher, update)
+        elapsed = time.perf_counter() - start
+    if output:
+        output.close()
+    marvin.db.set_trace_callback(None)
+    marvin.store.engine.set_trace_callback(None)
+    return stats.summary(elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--updates", help="JSON lines file of recorded updates")
+    source.add_argument("--synthetic", type=int, help="Generate this many synthetic updates")
+    parser.add_argument("--chats", type=int, default=5, help="Synthetic: number of chats")
+    parser.add_argument("--users", type=int, default=20, help="Synthetic: users per chat")
+    parser.add_argument("--triggers", type=int, default=5, help="Synthetic: triggers per chat")
+    parser.add_argument("--seed", type=int, default=1, help="Synthetic: random seed")
+    parser.add_argument("--record", help="Write the updates being replayed to this JSON lines file")
+    parser.add_argument("--database", help="Start from a copy of this marvin.db instead of an empty one")
+    parser.add_argument("--workspace", help="Directory to run in (default: a new temporary directory)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds of simulated latency per Bot API call")
+    parser.add_argument("--json", help="Also write the summary to this file")
+    parser.add_argument("--sql-profile", action="store_true", help="Profile every statement and print the worst with query plans")
+    parser.add_argument("--verbose", action="store_true", help="Let Marvin's console output through")
+    args = parser.parse_args()
+    if args.sql_profile:
+        os.environ["SQL_PROFILE"] = "True"
+
+    if args.updates:
+        updates = load_updates(os.path.abspath(args.updates))
+    else:
+        updates = synthetic_updates(args.synthetic, args.chats, args.users, args.triggers, args.seed)
+    if args.record:
+        with open(args.record, "w", encoding="utf8") as handle:
+            for data in updates:
+                handle.write(json.dumps(data, ensure_ascii=False) + "\n")
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    workspace = prepare_workspace(args.workspace, os.path.abspath(args.database) if args.database else None)
+    marvin = load_marvin()
+    summary = run(updates, FakeBot(latency=args.api_latency), marvin, quiet=not args.verbose)
+    summary["workspace"] = workspace
+
+    print_report(summary)
+    print_sql_profile(marvin)
+    if json_path:
+        with open(json_path, "w", encoding="utf8") as handle:
+            json.dump(summary, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
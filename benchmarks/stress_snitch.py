@@ -0,0 +1,236 @@
+"""
+Concurrency stress test for the Golden Snitch
+
+Posts a Snitch, then has hundreds of different users claim it at the same moment, each on its own thread calling
+hp_catch_snitch() (the claim and award step of the 'caught it!' reply). Checks that every round has exactly one
+winner, that exactly 20 points were awarded, that the game ended up closed and that the claim was committed in the
+same transaction as the award (every statement on the shared connection is recorded, nothing may commit in between). An expired House rule is
+left behind before each round so the rule cleanup on the way to the award is exercised too. Meanwhile another thread
+runs the JobQueue's callbacks back to back (bot_data and counter flushes, maintenance), each committing the shared
+connection the way they do in production, and a round only passes if they did commit while it ran. Exits non-zero if
+any round fails.
+
+The rest of the reply handling isn't run concurrently: the dispatcher runs handlers one at a time and Marvin's
+shared cursor isn't safe to use from several threads at once, it's the claim itself that has to hold up.
+
+Usage:
+- python3 benchmarks/stress_snitch.py
+- python3 benchmarks/stress_snitch.py --claimers 500 --rounds 10
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from fakebot import FakeBot, BOT_USER
+from replay import prepare_workspace, load_marvin, build_dispatcher, make_user, make_message
+
+CHAT_ID = -1003000000000
+
+
+class RecordingConnection:
+    """
+    Marvin's sqlite3 connection with every statement and commit noted on the way through, as (thread, statement),
+    while statements is a list. Not the connection's trace callback: SQLite calls that holding the connection's mutex,
+    and with the claimers and the jobs on the one connection it deadlocks against a thread that has the GIL and is
+    waiting for the mutex.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = None
+
+    def record(self, statement) -> None:
+        if self.statements is not None:
+            self.statements.append((threading.current_thread(), statement))
+
+    def execute(self, sql, params=()):
+        self.record(sql)
+        return self.connection.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        for _ in seq_of_params:
+            self.record(sql)
+        return self.connection.executemany(sql, seq_of_params)
+
+    def executescript(self, script):
+        # sqlite3 commits whatever is pending before running a script
+        self.record("COMMIT")
+        self.record(script)
+        return self.connection.executescript(script)
+
+    def cursor(self):
+        return RecordingCursor(self)
+
+    def commit(self) -> None:
+        self.record("COMMIT")
+        self.connection.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+class RecordingCursor:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.cursor = recorder.connection.cursor()
+
+    def execute(self, sql, params=()):
+        self.recorder.record(sql)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        for _ in seq_of_params:
+            self.recorder.record(sql)
+        return self.cursor.executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def record_statements(marvin) -> RecordingConnection:
+    """Puts a RecordingConnection in place of marvin.db everywhere Marvin keeps a reference to it"""
+    recorder = RecordingConnection(marvin.db)
+    marvin.db = marvin.pending_interactions.db = marvin.profile_store.db = marvin.store.engine.connection = recorder
+    return recorder
+
+
+def setup_chat(marvin, bot, dispatcher, claimers) -> list:
+    """Has every claimer say something first so they have a users row, and stops random characters interfering"""
+    user_ids = [7000000 + index for index in range(claimers)]
+    for index, user_id in enumerate(user_ids):
+        user = make_user(user_id)
+        bot.add_user(user_id, user['first_name'], user['username'])
+        dispatcher.process_update(Update.de_json({'update_id': index + 1, 'message': make_message(index + 1, CHAT_ID, user, "Lumos")}, bot))
+    marvin.db.execute("UPDATE config SET config_value = ? WHERE chat_id = ? AND config_name IN ('standard_characters_frequency', 'epic_characters_frequency', 'marvin_sass_frequency')", (10 ** 9, CHAT_ID))
+    marvin.db.commit()
+    marvin.store.cache.clear()
+    return user_ids
+
+
+def current_term(marvin) -> str:
+    return marvin.db.execute("SELECT term_id FROM hp_terms WHERE chat_id = ? AND is_current = 1", (CHAT_ID,)).fetchone()[0]
+
+
+def term_points(marvin) -> int:
+    return marvin.db.execute("SELECT COALESCE(SUM(points), 0) FROM hp_points WHERE chat_id = ? AND term_id = ?", (CHAT_ID, current_term(marvin))).fetchone()[0]
+
+
+def committed_together(statements) -> bool:
+    """True if the claim's UPDATE and the award's ledger INSERT were in one transaction, committed after both"""
+    claim = next((index for index, statement in enumerate(statements) if statement.startswith("UPDATE pending_interactions")), None)
+    if claim is None:
+        return False
+    award = next((index for index in range(claim, len(statements)) if statements[index].startswith("INSERT INTO hp_points_ledger")), None)
+    if award is None or "COMMIT" in statements[claim:award]:
+        return False
+    return "COMMIT" in statements[award:]
+
+
+def run_jobs(marvin, bot_persistence, stop) -> None:
+    """The scheduled jobs from build_updater(), as often as they'll go, each with something to write"""
+    cycle = 0
+    while not stop.is_set():
+        cycle += 1
+        bot_persistence.get_bot_data()["stress_snitch_cycle"] = cycle
+        bot_persistence.flush_changes()
+        marvin.set_counter(CHAT_ID, "stress_snitch_cycle", cycle)
+        marvin.flush_counters()
+        marvin.maintenance_job(None)
+
+
+def run_round(marvin, recorder, bot, dispatcher, bot_persistence, user_ids, snitch_message_id, first_update_id):
+    """
+    Every user claims the same Snitch at the same instant while the jobs run. Returns (winners, points awarded,
+    status, atomic, job commits, errors, seconds).
+    """
+    marvin.pending_interactions.add(CHAT_ID, snitch_message_id, marvin.pending.SNITCH, 3600)
+    # An expired Bellatrix block for hp_rules_checker to clean up on the way to the award
+    marvin.store.house_rules.add(CHAT_ID, "bellatrix_block", "Nobody", int(time.time()) - 60)
+    marvin.store.commit()
+    snitch = {'message_id': snitch_message_id, 'date': int(time.time()), 'chat': {'id': CHAT_ID, 'type': 'supergroup'}, 'from': BOT_USER, 'text': "Quick! The Golden Snitch just flew past your head!"}
+    updates = []
+    for index, user_id in enumerate(user_ids):
+        update_id = first_update_id + index
+        updates.append(Update.de_json({'update_id': update_id, 'message': make_message(update_id, CHAT_ID, make_user(user_id), "CAUGHT IT!", reply_to=snitch)}, bot))
+
+    term_id = current_term(marvin)
+    timestamp = int(time.time())
+    before = term_points(marvin)
+    results = []
+    errors = []
+    barrier = threading.Barrier(len(updates))
+
+    def claim(update):
+        context = CallbackContext.from_update(update, dispatcher)
+        barrier.wait()
+        try:
+            results.append(marvin.hp_catch_snitch(CHAT_ID, snitch_message_id, timestamp, term_id, update, context))
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=claim, args=(update,)) for update in updates]
+    stop = threading.Event()
+    jobs = threading.Thread(target=run_jobs, args=(marvin, bot_persistence, stop), name="jobs")
+    recorder.statements = []
+    start = time.perf_counter()
+    jobs.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    jobs.join()
+    recorded, recorder.statements = recorder.statements, None
+    statements = [statement for _, statement in recorded]
+    job_commits = sum(1 for thread, statement in recorded if thread is jobs and statement == "COMMIT")
+
+    winners = sum(1 for result in results if result is not None)
+    status = marvin.pending_interactions.get(CHAT_ID, snitch_message_id).status
+    return winners, term_points(marvin) - before, status, committed_together(statements), job_commits, errors, elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--claimers", type=int, default=200, help="Users replying to each Snitch at once")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--workspace", help="Directory to build the database in (default: a new temporary directory)")
+    args = parser.parse_args()
+
+    prepare_workspace(args.workspace)
+    marvin = load_marvin()
+    bot = FakeBot()
+    dispatcher = build_dispatcher(marvin, bot)
+    user_ids = setup_chat(marvin, bot, dispatcher, args.claimers)
+    recorder = record_statements(marvin)
+    bot_persistence = marvin.persistence.SQLitePersistence(marvin.db, marvin.PERSISTENCE_FLUSH_SECONDS, marvin.db_lock)
+
+    failed = 0
+    for round_number in range(args.rounds):
+        winners, awarded, status, atomic, job_commits, errors, elapsed = run_round(marvin, recorder, bot, dispatcher, bot_persistence, user_ids, 900000 + round_number, 100000 * (round_number + 1))
+        ok = winners == 1 and awarded == 20 and status == "closed" and atomic and job_commits and not errors
+        failed += not ok
+        print(f"Round {round_number + 1}: {args.claimers} claims in {elapsed:.2f}s, winners {winners}, points awarded {awarded}, status {status}, "
+              f"claim and award {'in one transaction' if atomic else 'COMMITTED SEPARATELY'}, {job_commits} job commits meanwhile, errors {len(errors)} {'OK' if ok else 'FAIL'}")
+        for error in errors[:3]:
+            print("  " + type(error).__name__ + ": " + str(error))
+
+    print(f"{args.rounds - failed}/{args.rounds} rounds had exactly one winner, awarded in the claim's transaction")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    main()
@@ -0,0 +1,292 @@
+"""
+Dice expression engine for Marvin's /roll command
+
+Supported syntax (case-insensitive, terms joined with + or -):
+- XdY       roll X dice with Y sides (X defaults to 1, d% is a d100)
+- XdY!      exploding dice, every maximum roll adds another die
+- XdYkhN    keep the highest N dice (khN, or kN for short)
+- XdYklN    keep the lowest N dice
+- XdYdhN    drop the highest N dice
+- XdYdlN    drop the lowest N dice
+- XdYadv    advantage, keep the highest die (a single die is rolled twice)
+- XdYdis    disadvantage, keep the lowest die (a single die is rolled twice)
+- N         a flat modifier e.g. 4d6kh3+2
+
+Cost is bounded by the limits passed in by the caller (normally pulled from the chat config).
+Large rolls are generated in bulk with random.choices and collapsed into a face -> count tally
+so memory stays flat, and anything above the summary threshold is reported as sum/min/max/distribution
+rather than every individual die.
+"""
+
+import random
+import re
+from collections import Counter, namedtuple
+from functools import lru_cache
+
+# Hard ceilings which apply regardless of chat config
+MAX_EXPRESSION_LENGTH = 100
+MAX_TERMS = 20
+MAX_MESSAGE_LENGTH = 4000
+
+# Dice are generated this many at a time so a large roll never holds the full list in memory
+ROLL_CHUNK_SIZE = 65536
+
+# How many buckets a summary distribution is squashed into when a die has a lot of sides
+MAX_DISTRIBUTION_BUCKETS = 10
+
+DICE_TERM = re.compile(r'\s*([+-])?\s*(\d*)d(\d+|%)((?:!|adv|dis|k[hl]?\d*|d[hl]\d*)*)', re.IGNORECASE)
+FLAT_TERM = re.compile(r'\s*([+-])?\s*(\d+)(?![\dd])', re.IGNORECASE)
+MODIFIER = re.compile(r'(!)|(adv|dis)|(k[hl]?|d[hl])(\d*)', re.IGNORECASE)
+
+DiceTerm = namedtuple('DiceTerm', ['sign', 'count', 'sides', 'explode', 'keep', 'keep_count'])
+FlatTerm = namedtuple('FlatTerm', ['sign', 'value'])
+DiceLimits = namedtuple('DiceLimits', ['max_dice', 'max_sides', 'summary_threshold'])
+TermResult = namedtuple('TermResult', ['term', 'rolls', 'kept', 'faces', 'total', 'dice_rolled'])
+RollResult = namedtuple('RollResult', ['expression', 'terms', 'total', 'dice_rolled', 'summary'])
+
+DEFAULT_LIMITS = DiceLimits(max_dice=100000, max_sides=1000, summary_threshold=100)
+
+
+class DiceError(ValueError):
+    """Raised when an expression can't be parsed or breaks the configured limits"""
+
+
+@lru_cache(maxsize=256)
+def parse(expression):
+    """Turn a dice expression into a tuple of DiceTerm/FlatTerm. Results are cached as people repeat rolls a lot."""
+    expression = expression.strip()
+    if not expression:
+        raise DiceError("Empty dice expression.")
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise DiceError("That expression is longer than my patience. Keep it under " + str(MAX_EXPRESSION_LENGTH) + " characters.")
+
+    terms = []
+    position = 0
+    while position < len(expression):
+        match = DICE_TERM.match(expression, position)
+        if match is None:
+            match = FLAT_TERM.match(expression, position)
+            if match is None:
+                raise DiceError("I don't understand '" + expression[position:].strip() + "'.")
+        sign, count = match.group(1), match.group(2)
+        if terms and sign is None:
+            raise DiceError("Terms need to be joined with + or -.")
+        sign = -1 if sign == '-' else 1
+
+        if match.re is FLAT_TERM:
+            terms.append(FlatTerm(sign, int(count)))
+        else:
+            terms.append(_dice_term(sign, count, match.group(3), match.group(4)))
+
+        if len(terms) > MAX_TERMS:
+            raise DiceError("Too many terms, the most I'll do is " + str(MAX_TERMS) + ".")
+        position = match.end()
+        while position < len(expression) and expression[position].isspace():
+            position += 1
+
+    return tuple(terms)
+
+
+def _dice_term(sign, count, sides, modifiers):
+    count = int(count) if count else 1
+    sides = 100 if sides == '%' else int(sides)
+    if count < 1 or sides < 1:
+        raise DiceError("Dice need at least one side and there needs to be at least one of them.")
+
+    explode = False
+    keep = None
+    keep_count = None
+    for match in MODIFIER.finditer(modifiers):
+        if match.group(1):
+            explode = True
+            continue
+        if keep is not None:
+            raise DiceError("Only one keep/drop/adv/dis modifier per dice term.")
+        if match.group(2):
+            keep = 'kh' if match.group(2).lower() == 'adv' else 'kl'
+            keep_count = 1
+            count = max(count, 2)
+        else:
+            keep = match.group(3).lower()
+            if keep == 'k':
+                keep = 'kh'
+            keep_count = int(match.group(4)) if match.group(4) else 1
+
+    if keep in ('dh', 'dl') and keep_count >= count:
+        raise DiceError("You can't drop every die you roll.")
+
+    return DiceTerm(sign, count, sides, explode, keep, keep_count)
+
+
+def roll(expression, limits=DEFAULT_LIMITS, rng=random):
+    """Parse and roll an expression, returning a RollResult. Raises DiceError on bad input or limits."""
+    terms = parse(expression)
+
+    requested_dice = sum(term.count for term in terms if isinstance(term, DiceTerm))
+    if requested_dice > limits.max_dice:
+        raise DiceError("That's " + str(requested_dice) + " dice. This group only lets me roll " + str(limits.max_dice) + " at a time.")
+    for term in terms:
+        if isinstance(term, DiceTerm) and term.sides > limits.max_sides:
+            raise DiceError("A d" + str(term.sides) + " is basically a sphere. This group allows up to d" + str(limits.max_sides) + ".")
+
+    summary = requested_dice > limits.summary_threshold
+    results = []
+    total = 0
+    dice_rolled = 0
+    # Every term's own dice are reserved up front, explosions only get what's left over
+    spare = limits.max_dice - requested_dice
+    for term in terms:
+        if isinstance(term, FlatTerm):
+            total += term.sign * term.value
+            results.append(term)
+            continue
+        result = _roll_term(term, spare, limits, summary, rng)
+        spare -= result.dice_rolled - term.count
+        dice_rolled += result.dice_rolled
+        total += term.sign * result.total
+        results.append(result)
+
+    return RollResult(expression, results, total, dice_rolled, summary or dice_rolled > limits.summary_threshold)
+
+
+def _roll_term(term, spare, limits, summary, rng):
+    faces = Counter()
+    rolls = None if summary else []
+    to_roll = term.count
+    dice_rolled = 0
+
+    # Exploding dice keep adding a die for every maximum until they stop, as long as there are spare dice for them
+    while to_roll > 0:
+        if dice_rolled + to_roll > term.count + spare:
+            raise DiceError("Those dice kept exploding past the " + str(limits.max_dice) + " this group lets me roll at a time.")
+        maxed = 0
+        for batch in _roll_batches(to_roll, term.sides, rng):
+            faces.update(batch)
+            if rolls is not None:
+                rolls.extend(batch)
+            if term.explode:
+                maxed += batch.count(term.sides)
+        dice_rolled += to_roll
+        to_roll = maxed if term.explode and term.sides > 1 else 0
+
+    kept = None
+    if term.keep is None:
+        term_total = sum(face * count for face, count in faces.items())
+    else:
+        keep_count = _keep_size(term, dice_rolled)
+        highest = term.keep in ('kh', 'dl')
+        term_total = _sum_extreme(faces, keep_count, highest)
+        if rolls is not None:
+            order = sorted(range(len(rolls)), key=rolls.__getitem__, reverse=highest)
+            kept = set(order[:keep_count])
+
+    return TermResult(term, rolls, kept, faces, term_total, dice_rolled)
+
+
+def _roll_batches(count, sides, rng):
+    # random.choices does the looping in C, which is around 5x quicker than calling randint per die
+    faces = range(1, sides + 1)
+    while count > 0:
+        size = min(count, ROLL_CHUNK_SIZE)
+        yield rng.choices(faces, k=size)
+        count -= size
+
+
+def _keep_size(term, dice_rolled):
+    if term.keep in ('kh', 'kl'):
+        return min(term.keep_count, dice_rolled)
+    return max(dice_rolled - term.keep_count, 0)
+
+
+def _sum_extreme(faces, keep_count, highest):
+    # Sum the highest/lowest keep_count dice straight off the tally, no sorting of individual rolls
+    total = 0
+    for face in sorted(faces, reverse=highest):
+        take = min(faces[face], keep_count)
+        total += face * take
+        keep_count -= take
+        if keep_count == 0:
+            break
+    return total
+
+
+def describe_term(term):
+    """Render a parsed term back into canonical notation e.g. 4d6kh3"""
+    if isinstance(term, FlatTerm):
+        return str(term.value)
+    text = str(term.count) + "d" + str(term.sides)
+    if term.explode:
+        text += "!"
+    if term.keep is not None:
+        text += term.keep + str(term.keep_count)
+    return text
+
+
+def format_result(result):
+    """Format a RollResult for Telegram, falling back to the summary if the full list won't fit in a message"""
+    if not result.summary:
+        text = _format_detailed(result)
+        if len(text) <= MAX_MESSAGE_LENGTH:
+            return text
+    return _format_summary(result)
+
+
+def _format_detailed(result):
+    lines = []
+    for index, item in enumerate(result.terms):
+        negative = (item.sign if isinstance(item, FlatTerm) else item.term.sign) < 0
+        if index == 0:
+            prefix = "-" if negative else ""
+        else:
+            prefix = "- " if negative else "+ "
+        if isinstance(item, FlatTerm):
+            lines.append(prefix + str(item.value))
+            continue
+        rolls = []
+        for position, value in enumerate(item.rolls):
+            if item.kept is not None and position not in item.kept:
+                rolls.append("(" + str(value) + ")")
+            else:
+                rolls.append(str(value))
+        lines.append(prefix + describe_term(item.term) + ": [" + ", ".join(rolls) + "] = " + str(item.total))
+    if len(result.terms) == 1 and not isinstance(result.terms[0], FlatTerm):
+        # Plain '/roll' or '/roll 1d20' should still just be a number
+        if len(result.terms[0].rolls) == 1:
+            return str(result.total)
+        return lines[0]
+    return "\n".join(lines) + "\n\nTotal: " + str(result.total)
+
+
+def _format_summary(result):
+    lines = ["Rolled " + str(result.dice_rolled) + " dice, the full list would be unbearable so here's the summary."]
+    for item in result.terms:
+        if isinstance(item, FlatTerm):
+            continue
+        faces = item.faces
+        count = sum(faces.values())
+        raw_sum = sum(face * tally for face, tally in faces.items())
+        lines.append("")
+        lines.append(describe_term(item.term) + (" (subtracted)" if item.term.sign < 0 else ""))
+        if not count:
+            lines.append("No dice rolled")
+            continue
+        lines.append("Sum: " + str(raw_sum) + ("  Kept: " + str(item.total) if item.term.keep else ""))
+        lines.append("Min: " + str(min(faces)) + "  Max: " + str(max(faces)) + "  Mean: " + format(raw_sum / count, ".2f"))
+        lines.append("Distribution:")
+        for label, tally in distribution(faces, item.term.sides):
+            lines.append("  " + label + ": " + str(tally) + " (" + format(100 * tally / count, ".1f") + "%)")
+    lines.append("")
+    lines.append("Total: " + str(result.total))
+    return "\n".join(lines)
+
+
+def distribution(faces, sides, buckets=MAX_DISTRIBUTION_BUCKETS):
+    """Return (label, count) pairs for a face tally, grouping faces into ranges when there are lots of sides"""
+    width = -(-sides // buckets)
+    pairs = []
+    for start in range(1, sides + 1, width):
+        end = min(start + width - 1, sides)
+        tally = sum(faces[face] for face in range(start, end + 1))
+        label = str(start) if start == end else str(start) + "-" + str(end)
+        pairs.append((label, tally))
+    return pairs
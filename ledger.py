@@ -0,0 +1,63 @@
+"""
+Append-only ledger of House points
+
+Every award, deduction and character effect is written to hp_points_ledger as its own entry (who, how much, why,
+who gave it, when). hp_points stays as the running total per user and term, kept by an atomic increment in the same
+transaction as the entry, so nothing that reads totals has to change and no read-modify-write can lose an update.
+
+Because the ledger is the record, totals can be recomputed for any term at any point in time with one aggregation
+over the hp_points_ledger_term index, and maintenance uses that to put hp_points right if it ever drifts.
+
+Functions take anything with an execute() (the connection, Marvin's cursor or a storage engine, see storage.py) and
+never commit, the caller decides what else belongs in the transaction.
+"""
+
+import timeutil
+
+# Reasons for entries that don't come from a person
+OPENING_BALANCE = "opening_balance"
+CORRECTION = "correction"
+
+
+def _total(db, chat_id, term_id, user_id) -> int:
+    row = db.execute("SELECT points FROM hp_points WHERE chat_id = ? AND term_id = ? AND user_id = ?", (chat_id, term_id, user_id)).fetchone()
+    return int(row[0]) if row else 0
+
+
+def record(db, chat_id, term_id, user_id, delta, reason, timestamp=None, actor_id=None) -> int:
+    """Adds delta to a user's points for the term as a ledger entry, timestamp in epoch seconds. Returns their new total."""
+    timestamp = timestamp or timeutil.now()
+    db.execute("INSERT INTO hp_points_ledger (chat_id, term_id, user_id, delta, reason, actor_id, created) VALUES (?, ?, ?, ?, ?, ?, ?)", (chat_id, term_id, user_id, delta, reason, actor_id, timestamp))
+    db.execute("INSERT INTO hp_points (user_id, chat_id, points, timestamp, term_id) VALUES (?, ?, ?, ?, ?) ON CONFLICT(chat_id, term_id, user_id) DO UPDATE SET points = hp_points.points + excluded.points, timestamp = excluded.timestamp", (user_id, chat_id, delta, timestamp, term_id))
+    return _total(db, chat_id, term_id, user_id)
+
+
+def set_total(db, chat_id, term_id, user_id, points, reason, timestamp=None, actor_id=None) -> int:
+    """For effects that set a total outright (Voldemort), recorded as whatever delta gets there. Returns that delta."""
+    delta = points - _total(db, chat_id, term_id, user_id)
+    if delta:
+        record(db, chat_id, term_id, user_id, delta, reason, timestamp, actor_id)
+    return delta
+
+
+def totals(db, chat_id, term_id, until=None) -> dict:
+    """user_id -> points for a term from the ledger alone, as they stood at until (epoch seconds) if given"""
+    if until is None:
+        rows = db.execute("SELECT user_id, SUM(delta) FROM hp_points_ledger WHERE chat_id = ? AND term_id = ? GROUP BY user_id", (chat_id, term_id)).fetchall()
+    else:
+        rows = db.execute("SELECT user_id, SUM(delta) FROM hp_points_ledger WHERE chat_id = ? AND term_id = ? AND created <= ? GROUP BY user_id", (chat_id, term_id, until)).fetchall()
+    return {row[0]: row[1] for row in rows}
+
+
+def drift(db, chat_id, term_id) -> dict:
+    """user_id -> (hp_points total, ledger total) for every user where the two disagree"""
+    stored = {row[0]: int(row[1]) for row in db.execute("SELECT user_id, points FROM hp_points WHERE chat_id = ? AND term_id = ?", (chat_id, term_id)).fetchall()}
+    computed = totals(db, chat_id, term_id)
+    return {user_id: (stored.get(user_id, 0), computed.get(user_id, 0)) for user_id in stored.keys() | computed.keys() if stored.get(user_id, 0) != computed.get(user_id, 0)}
+
+
+def rebuild_term(db, chat_id, term_id, timestamp=None) -> int:
+    """Replaces a term's hp_points rows with totals recomputed from the ledger. Returns how many rows it wrote."""
+    timestamp = timestamp or timeutil.now()
+    db.execute("DELETE FROM hp_points WHERE chat_id = ? AND term_id = ?", (chat_id, term_id))
+    return db.execute("INSERT INTO hp_points (user_id, chat_id, points, timestamp, term_id) SELECT user_id, chat_id, SUM(delta), ?, term_id FROM hp_points_ledger WHERE chat_id = ? AND term_id = ? GROUP BY user_id", (timestamp, chat_id, term_id)).rowcount
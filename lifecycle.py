@@ -0,0 +1,112 @@
+"""
+Shutdown flushing and a write-ahead journal for state Marvin holds in memory
+
+Anything buffered in memory (bot_data changes, the message counters, points announcements waiting on an edit) is
+lost if the process stops before it's written out. Two pieces cover that:
+
+- Lifecycle: subsystems register a flusher at startup, drain() runs them in registration order when Marvin is told
+  to stop (SIGTERM/SIGINT ends updater.idle(), sharded workers drain when the router stops them). It gives up at
+  the deadline so a hung flusher can't keep a deploy waiting, whatever didn't make it is still in the journal.
+- Journal: an append-only file of JSON lines. A buffer appends each change before applying it in memory, and
+  truncates the journal once the buffered state is committed. Whatever is left at startup is what a crash or a
+  missed deadline didn't get to write, the owner replays it before reading anything.
+
+Lines are written through to the OS on every append, which survives the process dying. fsync=True also survives
+the machine losing power, at the price of a disk sync per change.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self._handle = None
+        self._lock = threading.Lock()
+
+    def append(self, record) -> None:
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._handle is None:
+                self._handle = open(self.path, "a", encoding="utf8")
+            self._handle.write(line)
+            self._handle.flush()
+            if self.fsync:
+                os.fsync(self._handle.fileno())
+
+    def records(self) -> list:
+        """Everything appended since the last truncate(). A line cut short by a crash is skipped."""
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, encoding="utf8") as handle:
+            for number, line in enumerate(handle, 1):
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping unreadable line %d of %s", number, self.path)
+        return records
+
+    def truncate(self) -> None:
+        """Call once everything appended so far is safely stored"""
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._handle is not None:
+                self._handle.close()
+                self._handle = None
+
+
+class Lifecycle:
+    def __init__(self, deadline=20):
+        # deadline: seconds drain() waits for the flushers before giving up
+        self.deadline = deadline
+        self._flushers = []
+        self._drained = False
+        self._lock = threading.Lock()
+
+    def register(self, name, flush) -> None:
+        """flush() is called once at shutdown, after everything registered before it"""
+        self._flushers.append((name, flush))
+
+    def drain(self) -> bool:
+        """Runs the flushers in order, only the first call does anything. Returns False if the deadline passed first."""
+        with self._lock:
+            if self._drained:
+                return True
+            self._drained = True
+        current = [None]
+        finished = threading.Event()
+
+        def run():
+            for name, flush in self._flushers:
+                current[0] = name
+                start = time.monotonic()
+                try:
+                    flush()
+                except Exception:
+                    # The others still get their turn, whatever this one held is replayed from its journal
+                    logger.exception("Shutdown: flushing %s failed", name)
+                else:
+                    logger.info("Shutdown: flushed %s in %.2fs", name, time.monotonic() - start)
+            finished.set()
+
+        # A thread so a flusher stuck on the network can't hold the process past the deadline
+        threading.Thread(target=run, name="marvin-shutdown", daemon=True).start()
+        if not finished.wait(self.deadline):
+            logger.error("Shutdown: gave up after %.0fs while flushing %s", self.deadline, current[0])
+            return False
+        return True
@@ -0,0 +1,176 @@
+"""
+Logging setup for Marvin
+
+Everything is logged through a QueueHandler so the worker thread that logs only pays for putting the record on a
+queue. A QueueListener thread does the formatting and the writing, so a slow terminal or log collector on the
+other end of stdout/stderr can't hold up message handling. If the queue fills up, records are dropped and counted
+instead of blocking.
+
+Per message logging goes to the 'marvin.messages' logger, which can be sampled (LOG_MESSAGE_SAMPLE) and have the
+message text redacted (LOG_REDACT_TEXT). LOG_FORMAT=json writes one JSON object per line with chat/user/handler
+fields for anything that wants to parse the logs.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+
+MESSAGE_LOGGER = "marvin.messages"
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Extra attributes that are lifted into their own JSON fields when a record has them
+CONTEXT_FIELDS = ("chat_id", "chat_title", "user_id", "username", "handler", "text")
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the handler and chat the logging thread is working for. Runs on the calling thread."""
+
+    def __init__(self, scope=None):
+        super().__init__()
+        self.scope = scope
+
+    def filter(self, record):
+        if self.scope is not None:
+            handler, chat_id = self.scope()
+            if getattr(record, "handler", None) is None:
+                record.handler = handler
+            if getattr(record, "chat_id", None) is None:
+                record.chat_id = chat_id
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through roughly rate * 100 percent of records. Warnings and above always get through."""
+
+    def __init__(self, rate=1.0, seed=None):
+        super().__init__()
+        self.rate = rate
+        self._random = random.Random(seed)
+
+    def filter(self, record):
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        return self._random.random() < self.rate
+
+
+class RedactFilter(logging.Filter):
+    """Swaps the text attribute for its length so message contents never reach the logs"""
+
+    def filter(self, record):
+        text = getattr(record, "text", None)
+        if text is not None:
+            record.text = "[redacted %d chars]" % len(text)
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """The usual console format, with the message text (if any) on the following line"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        line = super().format(record)
+        text = getattr(record, "text", None)
+        if text is not None:
+            line += "\n" + str(text)
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records rather than waiting when the listener has fallen behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # The stock prepare() formats the whole record here on the calling thread, which is the work we're trying
+        # to move off it. Only the message is merged, so mutable args can't change before the listener gets to it.
+        # The listener is a thread in this process, so exc_info can cross the queue as it is.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+class LogSetup:
+    """What setup_logging() started, kept so callers can report on and stop it"""
+
+    def __init__(self, handler, listener):
+        self.handler = handler
+        self.listener = listener
+
+    @property
+    def dropped(self) -> int:
+        return self.handler.dropped
+
+    def stop(self) -> None:
+        # Flushes whatever is still queued
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+
+def setup_logging(level=logging.INFO, json_format=False, message_sample=1.0, redact_text=False, queue_size=10000, scope=None, stream=None) -> LogSetup:
+    """Replaces the root handlers with a queue in front of a single stream handler running on a listener thread"""
+    formatter = JSONFormatter() if json_format else TextFormatter()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(formatter)
+
+    handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    handler.addFilter(ContextFilter(scope))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    messages = logging.getLogger(MESSAGE_LOGGER)
+    for existing in list(messages.filters):
+        messages.removeFilter(existing)
+    if message_sample < 1.0:
+        messages.addFilter(SamplingFilter(message_sample))
+    if redact_text:
+        messages.addFilter(RedactFilter())
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    setup = LogSetup(handler, listener)
+    atexit.register(setup.stop)
+    return setup
@@ -0,0 +1,202 @@
+"""
+Scheduled database maintenance for Marvin
+
+Run from the JobQueue every MAINTENANCE_INTERVAL_HOURS (and on demand with the owner-only /maintenance):
+- bot_service_messages older than their retention (deletes that failed, or chats that went quiet). Telegram won't
+  let a bot delete messages older than 48 hours so past that point the rows are useless anyway.
+- bot_question_messages nobody ever answered
+- hp_points for terms that closed more than ARCHIVE_TERMS_AFTER_DAYS ago move to hp_points_archive, so the hot path
+  only scans live terms. The archive itself can be trimmed with RETAIN_ARCHIVE_DAYS (0 keeps it forever).
+- hp_points for current terms is checked against hp_points_ledger and recomputed from it where they disagree
+- PRAGMA incremental_vacuum hands freed pages back to the filesystem, then a bounded ANALYZE refreshes the planner's
+  statistics
+
+Deletes and moves happen in batches of rowids, each committed separately, so no single write holds the database
+lock for long while the bot is handling messages.
+
+The connection is shared with the handlers, so every batch (and each term's drift check and rebuild) runs holding
+the lock passed to run_maintenance(). A handler holding it across a multi-statement write, like a ledger entry and
+its hp_points total, can't have maintenance commit half of it or see it half written.
+"""
+
+import contextlib
+import logging
+import time
+from collections import namedtuple
+
+import ledger
+import timeutil
+
+logger = logging.getLogger(__name__)
+
+# Rows ANALYZE samples per index, keeps it quick on big tables
+ANALYSIS_LIMIT = 1000
+
+# For callers that have the connection to themselves
+NO_LOCK = contextlib.nullcontext()
+
+# Hours/days of 0 switch that step off
+RetentionPolicy = namedtuple("RetentionPolicy", "service_messages_hours questions_hours archive_terms_after_days archive_days batch_size")
+
+DEFAULT_POLICY = RetentionPolicy(service_messages_hours=48, questions_hours=72, archive_terms_after_days=7, archive_days=0, batch_size=500)
+
+
+class MaintenanceReport:
+    def __init__(self):
+        self.deleted = {}
+        self.archived = 0
+        self.reconciled = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+        self.vacuumed = False
+        self.analyzed = False
+        self.errors = []
+        self.elapsed = 0.0
+
+    @property
+    def bytes_reclaimed(self) -> int:
+        return max(self.bytes_before - self.bytes_after, 0)
+
+    def add_deleted(self, table, rows) -> None:
+        self.deleted[table] = self.deleted.get(table, 0) + rows
+
+    def summary(self) -> str:
+        lines = ["Database maintenance finished in " + f"{self.elapsed:.1f}s"]
+        for table, rows in self.deleted.items():
+            lines.append(f"{table}: {rows} rows deleted")
+        lines.append(f"hp_points: {self.archived} rows archived")
+        if self.reconciled:
+            lines.append(f"hp_points: {self.reconciled} terms rebuilt from the ledger")
+        lines.append(f"File size {self.bytes_before / 1024:.0f}KB -> {self.bytes_after / 1024:.0f}KB, {self.bytes_reclaimed / 1024:.0f}KB reclaimed")
+        if not self.analyzed:
+            lines.append("ANALYZE skipped")
+        for error in self.errors:
+            lines.append("Error: " + error)
+        return "\n".join(lines)
+
+
+def ensure_schema(db) -> None:
+    """Archive table plus the created_date column bot_question_messages needs for retention. Safe to run every start."""
+    db.execute("CREATE TABLE IF NOT EXISTS 'hp_points_archive' ('user_id' INTEGER NOT NULL, chat_id INT NOT NULL, 'points' INT NOT NULL, 'timestamp' INTEGER NOT NULL, 'term_id' TEXT NOT NULL, 'archived_date' INTEGER NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS hp_points_archive_term ON hp_points_archive (chat_id, term_id)")
+    columns = [row[1] for row in db.execute("PRAGMA table_info(bot_question_messages)").fetchall()]
+    if columns and "created_date" not in columns:
+        db.execute("ALTER TABLE bot_question_messages ADD COLUMN created_date INTEGER")
+    db.commit()
+
+
+def database_bytes(db) -> int:
+    page_size = db.execute("PRAGMA page_size").fetchone()[0]
+    page_count = db.execute("PRAGMA page_count").fetchone()[0]
+    return page_size * page_count
+
+
+def table_exists(db, table) -> bool:
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def delete_in_batches(db, table, where, params, batch_size, lock=NO_LOCK) -> int:
+    """Deletes matching rows batch_size at a time, committing between batches. Returns the number deleted."""
+    total = 0
+    while True:
+        with lock:
+            rowids = [row[0] for row in db.execute(f"SELECT rowid FROM {table} WHERE {where} LIMIT ?", (*params, batch_size)).fetchall()]
+            if not rowids:
+                return total
+            db.execute(f"DELETE FROM {table} WHERE rowid IN ({','.join('?' * len(rowids))})", rowids)
+            db.commit()
+        total += len(rowids)
+
+
+def archive_closed_terms(db, cutoff, batch_size, timestamp, lock=NO_LOCK) -> int:
+    """Moves hp_points rows for terms that ended before cutoff into hp_points_archive"""
+    closed = db.execute("SELECT chat_id, term_id FROM hp_terms WHERE is_current = 0 AND end_date < ?", (cutoff,)).fetchall()
+    total = 0
+    for chat_id, term_id in closed:
+        while True:
+            with lock:
+                rowids = [row[0] for row in db.execute("SELECT rowid FROM hp_points WHERE chat_id = ? AND term_id = ? LIMIT ?", (chat_id, term_id, batch_size)).fetchall()]
+                if not rowids:
+                    break
+                placeholders = ','.join('?' * len(rowids))
+                db.execute(f"INSERT INTO hp_points_archive (user_id, chat_id, points, timestamp, term_id, archived_date) SELECT user_id, chat_id, points, timestamp, term_id, ? FROM hp_points WHERE rowid IN ({placeholders})", (timestamp, *rowids))
+                db.execute(f"DELETE FROM hp_points WHERE rowid IN ({placeholders})", rowids)
+                db.commit()
+            total += len(rowids)
+    return total
+
+
+def reconcile_current_terms(db, timestamp, lock=NO_LOCK) -> int:
+    """
+    Rebuilds hp_points from the ledger for any current term where the totals have drifted. Returns how many. The check
+    and the rebuild for a term happen under one hold of the lock, an award whose ledger entry is written but whose
+    total isn't yet would otherwise look like drift and be counted twice.
+    """
+    rebuilt = 0
+    for chat_id, term_id in db.execute("SELECT chat_id, term_id FROM hp_terms WHERE is_current = 1").fetchall():
+        with lock:
+            differences = ledger.drift(db, chat_id, term_id)
+            if not differences:
+                continue
+            logger.warning("hp_points drifted from the ledger for %d users, rebuilding the term", len(differences), extra={'chat_id': chat_id})
+            ledger.rebuild_term(db, chat_id, term_id, timestamp)
+            db.commit()
+        rebuilt += 1
+    return rebuilt
+
+
+def compact(db, report) -> None:
+    """Frees unused pages. Needs incremental auto_vacuum, which migration 6 switched the file to before polling started."""
+    try:
+        # sqlite3 steps a statement without result columns only once, which frees a single page. executescript()
+        # runs it to completion (after committing whatever is pending, like the batches do).
+        db.executescript("PRAGMA incremental_vacuum;")
+        report.vacuumed = True
+    except Exception as ex:
+        # Most likely another thread has a transaction open, next run will get it
+        report.errors.append("vacuum: " + str(ex))
+    try:
+        db.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+        db.execute("ANALYZE")
+        db.commit()
+        report.analyzed = True
+    except Exception as ex:
+        report.errors.append("analyze: " + str(ex))
+
+
+def run_maintenance(db, policy=DEFAULT_POLICY, now=None, lock=NO_LOCK) -> MaintenanceReport:
+    """now is epoch seconds, the current time if not given. lock is held for each batch, see the module docstring."""
+    report = MaintenanceReport()
+    start = time.perf_counter()
+    timestamp = now or timeutil.now()
+    report.bytes_before = database_bytes(db)
+
+    if policy.service_messages_hours and table_exists(db, "bot_service_messages"):
+        # MostRecent is one row per chat that gets updated in place, not something to expire
+        cutoff = timestamp - policy.service_messages_hours * 3600
+        report.add_deleted("bot_service_messages", delete_in_batches(db, "bot_service_messages", "created_date < ? AND type != 'MostRecent'", (cutoff,), policy.batch_size, lock))
+
+    if policy.questions_hours and table_exists(db, "bot_question_messages"):
+        # Questions from before created_date existed start their clock now
+        with lock:
+            db.execute("UPDATE bot_question_messages SET created_date = ? WHERE created_date IS NULL", (timestamp,))
+            db.commit()
+        cutoff = timestamp - policy.questions_hours * 3600
+        report.add_deleted("bot_question_messages", delete_in_batches(db, "bot_question_messages", "created_date < ?", (cutoff,), policy.batch_size, lock))
+
+    if policy.archive_terms_after_days and table_exists(db, "hp_terms") and table_exists(db, "hp_points"):
+        cutoff = timestamp - policy.archive_terms_after_days * 86400
+        report.archived = archive_closed_terms(db, cutoff, policy.batch_size, timestamp, lock)
+
+    if policy.archive_days:
+        cutoff = timestamp - policy.archive_days * 86400
+        report.add_deleted("hp_points_archive", delete_in_batches(db, "hp_points_archive", "archived_date < ?", (cutoff,), policy.batch_size, lock))
+
+    if table_exists(db, "hp_points_ledger") and table_exists(db, "hp_terms"):
+        report.reconciled = reconcile_current_terms(db, timestamp, lock)
+
+    with lock:
+        compact(db, report)
+    report.bytes_after = database_bytes(db)
+    report.elapsed = time.perf_counter() - start
+    return report
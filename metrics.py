@@ -0,0 +1,294 @@
+"""
+Runtime instrumentation for Marvin
+
+Wraps every registered handler and the Bot's API transport so we can see which handler is slow, how many
+SQL statements and Bot API calls each one costs, and which chats are generating the load.
+
+Metrics are kept in-process and exposed two ways:
+- Prometheus text format over a small local HTTP server (METRICS_PORT in .env, off by default)
+- The owner-only /stats command
+
+No external dependencies, the Prometheus exposition format is simple enough to write out by hand.
+"""
+
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.ext import ExtBot
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, weighted towards the few-millisecond range most handlers live in
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used when a statement or API call happens outside any handler (job queue, polling, startup)
+NO_HANDLER = "none"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """A monotonically increasing value per label set"""
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1) -> None:
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set, the same shape Prometheus expects"""
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value) -> None:
+        with self._lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def count(self, labels=()) -> int:
+        series = self.values.get(labels)
+        return series[2] if series else 0
+
+    def total(self, labels=()) -> float:
+        series = self.values.get(labels)
+        return series[1] if series else 0.0
+
+    def quantile(self, labels, fraction) -> float:
+        """Upper bound of the bucket the quantile falls in. Coarse, but good enough to spot a slow handler."""
+        series = self.values.get(labels)
+        if not series or not series[2]:
+            return 0.0
+        target = fraction * series[2]
+        running = 0
+        for bound, hits in zip(self.buckets, series[0]):
+            running += hits
+            if running >= target:
+                return bound
+        return float("inf")
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (hits, total, count) in sorted(self.values.items()):
+                running = 0
+                for bound, bucket_hits in zip(self.buckets, hits):
+                    running += bucket_hits
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, (('le', bound),))} {running}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, labels, (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = REGISTRY.register(Histogram("marvin_handler_latency_seconds", "Time spent in each handler", ("handler",)))
+HANDLER_ERRORS = REGISTRY.register(Counter("marvin_handler_errors_total", "Exceptions raised by each handler", ("handler",)))
+HANDLER_SQL = REGISTRY.register(Counter("marvin_handler_sql_statements_total", "SQL statements executed by each handler", ("handler",)))
+HANDLER_API = REGISTRY.register(Counter("marvin_handler_api_calls_total", "Bot API calls made by each handler", ("handler", "method")))
+API_LATENCY = REGISTRY.register(Histogram("marvin_api_latency_seconds", "Bot API round trip time", ("method",)))
+CHAT_UPDATES = REGISTRY.register(Counter("marvin_chat_updates_total", "Handler invocations per chat", ("chat_id",)))
+CHAT_SECONDS = REGISTRY.register(Counter("marvin_chat_handler_seconds_total", "Handler time spent per chat", ("chat_id",)))
+CHAT_ERRORS = REGISTRY.register(Counter("marvin_chat_errors_total", "Handler exceptions per chat", ("chat_id",)))
+CHAT_SQL = REGISTRY.register(Counter("marvin_chat_sql_statements_total", "SQL statements executed per chat", ("chat_id",)))
+CHAT_API = REGISTRY.register(Counter("marvin_chat_api_calls_total", "Bot API calls made per chat", ("chat_id",)))
+STAGE_LATENCY = REGISTRY.register(Histogram("marvin_stage_latency_seconds", "Time spent in each stage of a handler's pipeline, see pipeline.py", ("pipeline", "stage")))
+
+# Which handler/chat the current thread is working for. Handlers can run on worker threads so this can't be a global.
+_scope = threading.local()
+
+
+def current_scope():
+    return getattr(_scope, "handler", None), getattr(_scope, "chat_id", None)
+
+
+def instrument_handler(callback):
+    """Wraps a handler callback to record latency, errors and the chat it ran for"""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    def instrumented(update, context):
+        chat = getattr(update, "effective_chat", None)
+        chat_id = chat.id if chat else None
+        previous = current_scope()
+        _scope.handler, _scope.chat_id = name, chat_id
+        start = time.perf_counter()
+        try:
+            return callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc((name,))
+            if chat_id is not None:
+                CHAT_ERRORS.inc((chat_id,))
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_LATENCY.observe((name,), elapsed)
+            if chat_id is not None:
+                CHAT_UPDATES.inc((chat_id,))
+                CHAT_SECONDS.inc((chat_id,), elapsed)
+            _scope.handler, _scope.chat_id = previous
+    return instrumented
+
+
+def count_statement(statement) -> None:
+    """Storage engine trace callback, counts every statement against the handler and chat running on this thread"""
+    handler, chat_id = current_scope()
+    HANDLER_SQL.inc((handler or NO_HANDLER,))
+    if chat_id is not None:
+        CHAT_SQL.inc((chat_id,))
+
+
+def record_api_call(endpoint, elapsed) -> None:
+    handler, chat_id = current_scope()
+    API_LATENCY.observe((endpoint,), elapsed)
+    HANDLER_API.inc((handler or NO_HANDLER, endpoint))
+    if chat_id is not None:
+        CHAT_API.inc((chat_id,))
+
+
+class InstrumentedBot(ExtBot):
+    """ExtBot that times and counts every API call. All Bot methods funnel through _post so this catches the lot."""
+
+    def _post(self, endpoint, data=None, timeout=None, api_kwargs=None):
+        start = time.perf_counter()
+        try:
+            return super()._post(endpoint, data, timeout, api_kwargs)
+        finally:
+            # Long polling would swamp the latency histogram, it isn't interesting anyway
+            if endpoint != "getUpdates":
+                record_api_call(endpoint, time.perf_counter() - start)
+
+
+def instrument_dispatcher(dispatcher, engine) -> None:
+    """
+    Wraps every handler registered on the dispatcher and starts counting the statements the storage engine runs
+    (storage.py), whichever backend that is. Statements modules run on marvin.db themselves (bot_data, pending
+    interactions, profiles) aren't counted, a sqlite3 trace callback on the connection the job threads share can
+    deadlock.
+    """
+    for group in dispatcher.groups:
+        for handler in dispatcher.handlers[group]:
+            handler.callback = instrument_handler(handler.callback)
+    engine.set_trace_callback(count_statement)
+
+
+def handler_report(limit=15) -> list:
+    """Rows of (handler, calls, mean_ms, p99_ms, errors, sql_per_call, api_per_call), busiest first"""
+    rows = []
+    api_by_handler = {}
+    for (handler, _), value in list(HANDLER_API.values.items()):
+        api_by_handler[handler] = api_by_handler.get(handler, 0) + value
+    for (handler,) in list(HANDLER_LATENCY.values):
+        calls = HANDLER_LATENCY.count((handler,))
+        rows.append((
+            handler,
+            calls,
+            1000 * HANDLER_LATENCY.total((handler,)) / calls,
+            1000 * HANDLER_LATENCY.quantile((handler,), 0.99),
+            HANDLER_ERRORS.get((handler,)),
+            HANDLER_SQL.get((handler,)) / calls,
+            api_by_handler.get(handler, 0) / calls,
+        ))
+    rows.sort(key=lambda row: row[1] * row[2], reverse=True)
+    return rows[:limit]
+
+
+def stage_report() -> list:
+    """Rows of (pipeline, stage, calls, mean_ms, p99_ms), in the order the stages first ran"""
+    rows = []
+    for (pipeline, stage) in list(STAGE_LATENCY.values):
+        calls = STAGE_LATENCY.count((pipeline, stage))
+        rows.append((pipeline, stage, calls, 1000 * STAGE_LATENCY.total((pipeline, stage)) / calls, 1000 * STAGE_LATENCY.quantile((pipeline, stage), 0.99)))
+    return rows
+
+
+def chat_report(limit=5) -> list:
+    """Rows of (chat_id, updates, seconds, sql, api), most expensive chats first"""
+    rows = []
+    for (chat_id,), updates in list(CHAT_UPDATES.values.items()):
+        rows.append((chat_id, updates, CHAT_SECONDS.get((chat_id,)), CHAT_SQL.get((chat_id,)), CHAT_API.get((chat_id,))))
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows[:limit]
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the console
+        pass
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """Serves /metrics on a daemon thread. Binds to localhost by default, put a proxy in front if it needs to go further."""
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info("Serving Prometheus metrics on http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,173 @@
+"""
+Schema migrations for marvin.db
+
+The database's PRAGMA user_version records the last migration applied. migrate() runs everything newer in order,
+each migration in its own transaction together with the user_version bump, so a failure leaves the database at
+the previous version rather than half migrated.
+
+To add one, write a function taking the connection and append it to MIGRATIONS. Never edit or reorder a migration
+that has shipped, existing databases have already run it. A migration that can't run inside a transaction (VACUUM)
+goes in OUTSIDE_TRANSACTION as well and has to be safe to run again, a crash can stop it before the version bump.
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# auto_vacuum values as reported by PRAGMA auto_vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def column_names(db, table) -> list:
+    return [row[1] for row in db.execute(f"PRAGMA table_info({table})").fetchall()]
+
+
+def add_users_last_seen(db) -> None:
+    """users.last_seen as epoch seconds, indexed for /activity"""
+    if "last_seen" not in column_names(db, "users"):
+        db.execute("ALTER TABLE users ADD COLUMN last_seen INTEGER")
+    # timestamp is local time, the 'utc' modifier converts it
+    db.execute("UPDATE users SET last_seen = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE last_seen IS NULL")
+    db.execute("CREATE INDEX IF NOT EXISTS users_activity ON users (chat_id, last_seen) WHERE status NOT IN ('kicked', 'left')")
+
+
+def add_user_profiles(db) -> None:
+    """user_profiles for rendering mentions locally, seeded with the usernames the users table already has"""
+    db.execute("CREATE TABLE IF NOT EXISTS user_profiles ([user_id] INTEGER PRIMARY KEY, [first_name] TEXT, [last_name] TEXT, [username] TEXT, [updated] INTEGER)")
+    # Most recently seen username wins for people in more than one chat, names fill in as they next speak
+    db.execute("INSERT OR IGNORE INTO user_profiles (user_id, username, updated) SELECT user_id, username, MAX(last_seen) FROM users WHERE username IS NOT NULL GROUP BY user_id")
+
+
+def add_users_username_norm(db) -> None:
+    """users.username_norm, the lowercase username @mentions are resolved against, indexed per chat"""
+    if "username_norm" not in column_names(db, "users"):
+        db.execute("ALTER TABLE users ADD COLUMN username_norm TEXT")
+    # Telegram usernames are ASCII, so SQLite's lower() matches str.lower() for them
+    db.execute("UPDATE users SET username_norm = lower(username) WHERE username_norm IS NULL")
+    db.execute("CREATE INDEX IF NOT EXISTS users_username ON users (chat_id, username_norm)")
+
+
+def add_points_ledger(db) -> None:
+    """hp_points_ledger, with what's in hp_points now as everyone's opening balance, and one hp_points row per user and term"""
+    db.execute("CREATE TABLE IF NOT EXISTS hp_points_ledger ([entry_id] INTEGER PRIMARY KEY, [chat_id] INTEGER NOT NULL, [term_id] TEXT NOT NULL, [user_id] INTEGER NOT NULL, [delta] INTEGER NOT NULL, [reason] TEXT NOT NULL, [actor_id] INTEGER, [created] INTEGER NOT NULL)")
+    # Covers both the per user sums and the point in time ones
+    db.execute("CREATE INDEX IF NOT EXISTS hp_points_ledger_term ON hp_points_ledger (chat_id, term_id, user_id, created, delta)")
+    # Fold any duplicate rows together so totals can be kept with an upsert
+    db.execute("UPDATE hp_points SET points = (SELECT SUM(other.points) FROM hp_points AS other WHERE other.chat_id = hp_points.chat_id AND other.term_id = hp_points.term_id AND other.user_id = hp_points.user_id) WHERE rowid IN (SELECT MIN(rowid) FROM hp_points GROUP BY chat_id, term_id, user_id HAVING COUNT(*) > 1)")
+    db.execute("DELETE FROM hp_points WHERE rowid NOT IN (SELECT MIN(rowid) FROM hp_points GROUP BY chat_id, term_id, user_id)")
+    db.execute("DROP INDEX IF EXISTS hp_points_user")
+    db.execute("CREATE UNIQUE INDEX hp_points_user ON hp_points (chat_id, term_id, user_id)")
+    db.execute("INSERT INTO hp_points_ledger (chat_id, term_id, user_id, delta, reason, created) SELECT chat_id, term_id, user_id, CAST(points AS INTEGER), 'opening_balance', COALESCE(CAST(strftime('%s', timestamp, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)) FROM hp_points")
+
+
+# Columns that held local '%Y-%m-%d %H:%M:%S' text until migration 5
+EPOCH_COLUMNS = {
+    "users": ["timestamp"],
+    "hp_points": ["timestamp"],
+    "hp_points_archive": ["timestamp", "archived_date"],
+    "hp_terms": ["start_date", "end_date"],
+    "hp_term_results": ["start_date", "end_date"],
+    "hp_config": ["expiry_time"],
+    "bot_service_messages": ["created_date"],
+    "bot_question_messages": ["created_date"],
+    "bot_data": ["updated_date"],
+}
+
+
+def legacy_to_epoch(column) -> str:
+    """SQL for a column's value as epoch seconds. Local time text is converted (now if it won't parse), integers and NULLs are left alone."""
+    return f"CASE WHEN {column} IS NULL OR typeof({column}) = 'integer' THEN {column} ELSE COALESCE(CAST(strftime('%s', {column}, 'utc') AS INTEGER), CAST(strftime('%s', 'now') AS INTEGER)) END"
+
+
+def rebuild_as_epoch(db, table, columns) -> None:
+    """
+    Converts columns to epoch seconds and declares them INTEGER. SQLite can't change a column's type in place, so
+    the table is rebuilt the way its documentation describes: create the new shape, copy, drop, rename, then put the
+    indexes back. rowids are kept. Tables that already declare the columns INTEGER only get their values converted.
+    """
+    row = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    if row is None:
+        return
+    existing = column_names(db, table)
+    columns = [column for column in columns if column in existing]
+    create = row[0]
+    for column in columns:
+        create = re.sub(r"""([\s,(]['"\[]?%s['"\]]?\s+)TEXT\b""" % re.escape(column), r"\1INTEGER", create, count=1, flags=re.IGNORECASE)
+    if create == row[0]:
+        for column in columns:
+            db.execute(f"UPDATE {table} SET {column} = {legacy_to_epoch(column)} WHERE typeof({column}) = 'text'")
+        return
+    indexes = [sql for (sql,) in db.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (table,)).fetchall()]
+    values = ", ".join(legacy_to_epoch(column) if column in columns else column for column in existing)
+    db.execute("CREATE TABLE migration_rebuild " + create[create.index("("):])
+    db.execute(f"INSERT INTO migration_rebuild (rowid, {', '.join(existing)}) SELECT rowid, {values} FROM {table}")
+    db.execute(f"DROP TABLE {table}")
+    db.execute(f"ALTER TABLE migration_rebuild RENAME TO {table}")
+    for sql in indexes:
+        db.execute(sql)
+
+
+def epoch_timestamps(db) -> None:
+    """Every time column as INTEGER epoch seconds (UTC) instead of local time text, with indexes for the range queries on them"""
+    for table, columns in EPOCH_COLUMNS.items():
+        rebuild_as_epoch(db, table, columns)
+    # del_bot_message looks up what's due per chat, maintenance what's expired across all of them
+    db.execute("CREATE INDEX IF NOT EXISTS bot_service_messages_chat ON bot_service_messages (chat_id, created_date)")
+    db.execute("CREATE INDEX IF NOT EXISTS bot_service_messages_expiry ON bot_service_messages (created_date) WHERE type != 'MostRecent'")
+    db.execute("CREATE INDEX IF NOT EXISTS hp_config_expiry ON hp_config (chat_id, expiry_time)")
+    db.execute("CREATE INDEX IF NOT EXISTS hp_terms_closed ON hp_terms (end_date) WHERE is_current = 0")
+    db.execute("CREATE INDEX IF NOT EXISTS bot_question_messages_created ON bot_question_messages (created_date)")
+    db.execute("CREATE INDEX IF NOT EXISTS hp_points_archive_archived ON hp_points_archive (archived_date)")
+
+
+def incremental_auto_vacuum(db) -> None:
+    """
+    auto_vacuum = INCREMENTAL, so scheduled maintenance can hand freed pages back a few at a time. An existing file
+    only switches with a full VACUUM, which rewrites it under the write lock, so that happens once here at startup
+    rather than from the maintenance job while messages are being handled.
+    """
+    if db.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute("VACUUM")
+
+
+MIGRATIONS = [
+    add_users_last_seen,
+    add_user_profiles,
+    add_users_username_norm,
+    add_points_ledger,
+    epoch_timestamps,
+    incremental_auto_vacuum,
+]
+
+# VACUUM fails inside a transaction
+OUTSIDE_TRANSACTION = (incremental_auto_vacuum,)
+
+
+def schema_version(db) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db) -> int:
+    """Brings the database up to date, returns the version it ends up at"""
+    version = schema_version(db)
+    # Nothing else may be pending when a migration opens its own transaction
+    db.commit()
+    for number, migration in enumerate(MIGRATIONS, 1):
+        if number <= version:
+            continue
+        logger.info("Applying migration %d: %s", number, migration.__name__)
+        try:
+            if migration not in OUTSIDE_TRANSACTION:
+                db.execute("BEGIN")
+            migration(db)
+            # PRAGMA doesn't take parameters
+            db.execute(f"PRAGMA user_version = {number}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            logger.exception("Migration %d failed, database left at version %d", number, version)
+            raise
+        version = number
+    return version
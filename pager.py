@@ -0,0 +1,150 @@
+"""
+Splits long Markdown output into Telegram sized pages and keeps rendered pages around per chat
+
+Pages are cut only where no Markdown entity is open (outside *bold*, _italic_, `code`, ```pre``` and [links](...)),
+preferring the gap between blocks, then line breaks, then spaces. A block that can't be cut safely anywhere is
+hard cut as a last resort, the caller should be ready to resend that page without parse_mode.
+
+PageCache holds the rendered pages keyed by (chat_id, kind) until something changes the underlying data and
+invalidates the chat.
+"""
+
+import threading
+from collections import OrderedDict
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Telegram's limit is 4096, a little headroom for headers and page counters
+PAGE_LENGTH = 3800
+
+BLOCK_SEPARATOR = "\n\n"
+
+
+def safe_cut_points(text) -> list:
+    """Indexes just after a newline or space where no Markdown entity is open, as (index, priority) with newlines first"""
+    points = []
+    state = None
+    index = 0
+    length = len(text)
+    while index < length:
+        char = text[index]
+        if char == "\\":
+            index += 2
+            continue
+        if state is None:
+            if text.startswith("```", index):
+                state = "```"
+                index += 3
+                continue
+            if char in "*_`":
+                state = char
+            elif char == "[":
+                state = "["
+            elif char == "\n":
+                points.append((index + 1, 1 if text.startswith("\n", index + 1) else 2))
+            elif char == " ":
+                points.append((index + 1, 3))
+        elif state == "```":
+            if text.startswith("```", index):
+                state = None
+                index += 3
+                continue
+        elif state == "[":
+            # Link text then (url), close once the url does
+            if char == ")":
+                state = None
+            elif char == "]" and not text.startswith("(", index + 1):
+                state = None
+        elif char == state:
+            state = None
+        index += 1
+    return points
+
+
+def split_text(text, limit=PAGE_LENGTH) -> list:
+    """Splits one piece of text into chunks no longer than limit, on safe boundaries where it can"""
+    chunks = []
+    while len(text) > limit:
+        candidates = [point for point in safe_cut_points(text[:limit + 1]) if point[0] <= limit]
+        # Strongest boundary in the back half of the chunk, otherwise the last safe one there is
+        back_half = [point for point in candidates if point[0] > limit // 2]
+        if back_half:
+            cut = max(back_half, key=lambda point: (-point[1], point[0]))[0]
+        elif candidates:
+            cut = candidates[-1][0]
+        else:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n")
+    if text.strip():
+        chunks.append(text)
+    return chunks
+
+
+def paginate(blocks, limit=PAGE_LENGTH, separator=BLOCK_SEPARATOR) -> list:
+    """Packs blocks into as few pages as fit, a block only gets split when it is bigger than a page on its own"""
+    pages = []
+    current = ""
+    for block in blocks:
+        pieces = split_text(block, limit) if len(block) > limit else [block]
+        for piece in pieces:
+            if current and len(current) + len(separator) + len(piece) > limit:
+                pages.append(current)
+                current = ""
+            current = current + separator + piece if current else piece
+    if current:
+        pages.append(current)
+    return pages
+
+
+def page_keyboard(prefix, page, total):
+    """Prev / x of y / Next buttons, callback data is '<prefix>:<page>'. None when there's only one page."""
+    if total <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{prefix}:{page - 1}"))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{total}", callback_data=f"{prefix}:{page}"))
+    if page < total - 1:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{prefix}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+class PageCache:
+    """Rendered pages per (chat_id, kind), least recently used chats fall out first"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped by invalidate() so a render that raced with a change isn't cached
+        self.generations = {}
+        self._lock = threading.Lock()
+
+    def get(self, chat_id, kind, render):
+        """Cached pages, or render() them and keep the result"""
+        key = (str(chat_id), kind)
+        with self._lock:
+            pages = self.entries.get(key)
+            if pages is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return pages
+            self.misses += 1
+            generation = self.generations.get(key[0], 0)
+        pages = render()
+        with self._lock:
+            if self.generations.get(key[0], 0) != generation:
+                return pages
+            self.entries[key] = pages
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return pages
+
+    def invalidate(self, chat_id) -> None:
+        chat_id = str(chat_id)
+        with self._lock:
+            self.generations[chat_id] = self.generations.get(chat_id, 0) + 1
+            for key in [key for key in self.entries if key[0] == chat_id]:
+                del self.entries[key]
@@ -0,0 +1,150 @@
+"""
+Bot messages that are waiting for someone to reply to them
+
+Trigger update questions, media trigger prompts and Snitch games all work the same way: Marvin posts a message and
+the next reply to it decides what happens. PendingRegistry keeps those messages in memory keyed by
+(chat_id, message_id), each with an expiry, so checking whether a reply matters is a dict lookup rather than a query.
+
+The pending_interactions table mirrors the registry only so a restart doesn't forget games and questions that are
+still open. It is written when an interaction is added, changes status or is resolved, never read after startup.
+"""
+
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Kinds of interaction
+QUESTION = "TriggerQuestion"
+MEDIA_TRIGGER = "MediaTrigger"
+SNITCH = "Snitch"
+
+
+class Interaction:
+    """One message waiting on a reply. data holds whatever the kind needs to act on the reply."""
+
+    __slots__ = ("chat_id", "message_id", "kind", "status", "expires", "data")
+
+    def __init__(self, chat_id, message_id, kind, status, expires, data):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.kind = kind
+        self.status = status
+        self.expires = expires
+        self.data = data
+
+    def __repr__(self):
+        return f"Interaction({self.chat_id}, {self.message_id}, {self.kind!r}, {self.status!r})"
+
+
+class PendingRegistry:
+    def __init__(self, db, clock=time.time):
+        self.db = db
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS pending_interactions ([chat_id] INTEGER NOT NULL, [message_id] INTEGER NOT NULL, [kind] TEXT NOT NULL, [status] TEXT NOT NULL, [expires] INTEGER NOT NULL, [data] TEXT, PRIMARY KEY (chat_id, message_id))")
+        self.db.commit()
+        self.load()
+
+    @staticmethod
+    def _key(chat_id, message_id):
+        return int(chat_id), int(message_id)
+
+    def load(self) -> int:
+        """Reads back whatever was still open when the bot last stopped, dropping anything that expired meanwhile"""
+        now = int(self.clock())
+        self.db.execute("DELETE FROM pending_interactions WHERE expires <= ?", (now,))
+        self.db.commit()
+        rows = self.db.execute("SELECT chat_id, message_id, kind, status, expires, data FROM pending_interactions").fetchall()
+        with self._lock:
+            for chat_id, message_id, kind, status, expires, data in rows:
+                self._entries[self._key(chat_id, message_id)] = Interaction(chat_id, message_id, kind, status, expires, json.loads(data) if data else {})
+        if rows:
+            logger.info("Recovered %d pending interactions", len(rows))
+        return len(rows)
+
+    def add(self, chat_id, message_id, kind, ttl, status="open", **data) -> Interaction:
+        chat_id, message_id = self._key(chat_id, message_id)
+        entry = Interaction(chat_id, message_id, kind, status, int(self.clock() + ttl), data)
+        with self._lock:
+            self._entries[(chat_id, message_id)] = entry
+            self.db.execute("INSERT OR REPLACE INTO pending_interactions (chat_id, message_id, kind, status, expires, data) VALUES (?, ?, ?, ?, ?, ?)", (chat_id, message_id, kind, status, entry.expires, json.dumps(data)))
+            self.db.commit()
+        return entry
+
+    def get(self, chat_id, message_id, kind=None):
+        """The live interaction for a message, or None. With kind, only an interaction of that kind."""
+        key = self._key(chat_id, message_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= self.clock():
+                self._remove(key)
+                return None
+        if kind is not None and entry.kind != kind:
+            return None
+        return entry
+
+    def set_status(self, chat_id, message_id, status) -> None:
+        key = self._key(chat_id, message_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.status = status
+            self.db.execute("UPDATE pending_interactions SET status = ? WHERE chat_id = ? AND message_id = ?", (status, *key))
+            self.db.commit()
+
+    def claim(self, chat_id, message_id, expected="open", status="closed") -> bool:
+        """
+        Compare-and-set on the status, for games only one person can win. Exactly one caller gets True for a given
+        transition however many race for it. The row update is left uncommitted so the caller can commit it in the
+        same transaction as whatever the claim wins, or rollback() and release() if that fails.
+        """
+        key = self._key(chat_id, message_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.status != expected or entry.expires <= self.clock():
+                return False
+            entry.status = status
+            self.db.execute("UPDATE pending_interactions SET status = ? WHERE chat_id = ? AND message_id = ? AND status = ?", (status, *key, expected))
+        return True
+
+    def release(self, chat_id, message_id, status="open") -> None:
+        """Undoes a claim() whose transaction was rolled back"""
+        self.set_status(chat_id, message_id, status)
+
+    def pop(self, chat_id, message_id, kind=None):
+        """Removes and returns the interaction, None if there wasn't a live one (of that kind)"""
+        key = self._key(chat_id, message_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (kind is not None and entry.kind != kind):
+                return None
+            self._remove(key)
+        if entry.expires <= self.clock():
+            return None
+        return entry
+
+    def _remove(self, key) -> None:
+        del self._entries[key]
+        self.db.execute("DELETE FROM pending_interactions WHERE chat_id = ? AND message_id = ?", key)
+        self.db.commit()
+
+    def purge_expired(self) -> int:
+        """Drops everything past its expiry. Returns how many went."""
+        now = self.clock()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry.expires <= now]
+            for key in expired:
+                del self._entries[key]
+            self.db.execute("DELETE FROM pending_interactions WHERE expires <= ?", (int(now),))
+            self.db.commit()
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
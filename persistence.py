@@ -0,0 +1,252 @@
+"""
+SQLite persistence for bot_data
+
+track_chats/show_chats keep the chat lists in context.bot_data, which python-telegram-bot only keeps in memory.
+SQLitePersistence stores bot_data in the bot_data table of Marvin's own database, one row per top level key with
+the value as JSON (sets are tagged so they come back as sets).
+
+- Startup only reads the key names, a value is loaded the first time something touches its key (LazyBotData)
+- Only keys touched since the last flush are re-encoded, and only the ones whose JSON changed are written
+- The dispatcher calls update_bot_data() after every update, writes are batched to once per flush_interval seconds
+  with a final flush when the Updater stops
+- Flushes happen on the dispatcher, JobQueue and shutdown threads. Pass the lock that guards the connection's open
+  transactions as db_lock so a flush can't commit something a handler is halfway through.
+
+user_data, chat_data and conversations aren't used by Marvin and aren't stored.
+"""
+
+import contextlib
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence
+
+logger = logging.getLogger(__name__)
+
+SET_TAG = "__set__"
+
+
+def encode(value) -> str:
+    def tag_sets(obj):
+        if isinstance(obj, (set, frozenset)):
+            return {SET_TAG: sorted(obj, key=str)}
+        raise TypeError(f"{type(obj).__name__} can't be stored in bot_data")
+    return json.dumps(value, default=tag_sets, sort_keys=True)
+
+
+def decode(raw):
+    def untag_sets(obj):
+        if len(obj) == 1 and SET_TAG in obj:
+            return set(obj[SET_TAG])
+        return obj
+    return json.loads(raw, object_hook=untag_sets)
+
+
+class LazyBotData(dict):
+    """
+    A dict that knows which keys exist in the database but only loads a value when it's asked for. Keeps track of the
+    keys that have been handed out (and so may have been changed in place) for the next flush.
+    """
+
+    def __init__(self, loader, keys):
+        super().__init__()
+        self._loader = loader
+        self._unloaded = set(keys)
+        self._lock = threading.RLock()
+        self.touched = set()
+        self.deleted = set()
+
+    def _load(self, key):
+        if key in self._unloaded:
+            with self._lock:
+                if key in self._unloaded:
+                    value = self._loader(key)
+                    if value is not None:
+                        super().__setitem__(key, value)
+                    self._unloaded.discard(key)
+
+    def _load_all(self):
+        for key in list(self._unloaded):
+            self._load(key)
+
+    def __getitem__(self, key):
+        self._load(key)
+        self.touched.add(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self._load(key)
+        self.touched.add(key)
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self._load(key)
+        self.touched.add(key)
+        return super().setdefault(key, default)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._unloaded.discard(key)
+            self.deleted.discard(key)
+            self.touched.add(key)
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._load(key)
+        with self._lock:
+            super().__delitem__(key)
+            self.touched.discard(key)
+            self.deleted.add(key)
+
+    def pop(self, key, *default):
+        self._load(key)
+        with self._lock:
+            if super().__contains__(key):
+                self.touched.discard(key)
+                self.deleted.add(key)
+            return super().pop(key, *default)
+
+    def __contains__(self, key):
+        return key in self._unloaded or super().__contains__(key)
+
+    # Anything that walks the whole dict needs every value loaded first
+    def __iter__(self):
+        self._load_all()
+        return super().__iter__()
+
+    def __len__(self):
+        return len(self._unloaded) + super().__len__()
+
+    def keys(self):
+        self._load_all()
+        return super().keys()
+
+    def values(self):
+        self._load_all()
+        self.touched.update(super().keys())
+        return super().values()
+
+    def items(self):
+        self._load_all()
+        self.touched.update(super().keys())
+        return super().items()
+
+    def __repr__(self):
+        self._load_all()
+        return super().__repr__()
+
+    def take_changes(self):
+        """Returns (touched, deleted) and starts tracking afresh"""
+        with self._lock:
+            touched, self.touched = self.touched, set()
+            deleted, self.deleted = self.deleted, set()
+        return touched, deleted
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores bot_data in the bot_data table of the given sqlite3 connection"""
+
+    def __init__(self, db, flush_interval=60, db_lock=None):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=True)
+        self.db = db
+        self.flush_interval = flush_interval
+        self.db_lock = db_lock if db_lock is not None else contextlib.nullcontext()
+        self.bot_data = None
+        # JSON as last written, so unchanged keys can be skipped
+        self._saved = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS bot_data ([data_key] TEXT PRIMARY KEY, [data_value] TEXT, [updated_date] INTEGER)")
+        self.db.commit()
+
+    # Only chat ids and other plain values live in bot_data, so there is never a Bot to swap out. The defaults copy
+    # the whole structure on every load and save, which would undo the lazy loading.
+    def insert_bot(self, obj):
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj):
+        return obj
+
+    def _load_value(self, key):
+        row = self.db.execute("SELECT data_value FROM bot_data WHERE data_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._saved[key] = row[0]
+        return decode(row[0])
+
+    def get_bot_data(self):
+        if self.bot_data is None:
+            keys = [row[0] for row in self.db.execute("SELECT data_key FROM bot_data").fetchall()]
+            self.bot_data = LazyBotData(self._load_value, keys)
+        return self.bot_data
+
+    def update_bot_data(self, data) -> None:
+        # Called after every update, so most calls just wait for the interval to pass
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush_changes()
+
+    def flush_changes(self) -> int:
+        """Writes every changed key now. Returns how many rows were written or deleted."""
+        if self.bot_data is None:
+            return 0
+        with self._lock:
+            self._last_flush = time.monotonic()
+            touched, deleted = self.bot_data.take_changes()
+            timestamp = int(time.time())
+            writes = []
+            for key in touched:
+                if not dict.__contains__(self.bot_data, key):
+                    continue
+                try:
+                    raw = encode(dict.__getitem__(self.bot_data, key))
+                except TypeError as ex:
+                    logger.error("Can't persist bot_data[%r]: %s", key, ex)
+                    continue
+                if raw != self._saved.get(key):
+                    writes.append((key, raw, timestamp))
+            if not writes and not deleted:
+                return 0
+            try:
+                # The commit takes whatever else is pending on the connection with it
+                with self.db_lock:
+                    self.db.executemany("INSERT INTO bot_data(data_key, data_value, updated_date) VALUES (?, ?, ?) ON CONFLICT(data_key) DO UPDATE SET data_value = excluded.data_value, updated_date = excluded.updated_date", writes)
+                    self.db.executemany("DELETE FROM bot_data WHERE data_key = ?", [(key,) for key in deleted])
+                    self.db.commit()
+            except Exception:
+                # Try again next time round rather than losing the change
+                self.bot_data.touched.update(key for key, _, _ in writes)
+                self.bot_data.deleted.update(deleted)
+                raise
+            for key, raw, _ in writes:
+                self._saved[key] = raw
+            for key in deleted:
+                self._saved.pop(key, None)
+        logger.debug("Persisted %d bot_data keys, removed %d", len(writes), len(deleted))
+        return len(writes) + len(deleted)
+
+    def flush(self) -> None:
+        # Updater.stop() calls this after a last update_persistence()
+        self.flush_changes()
+
+    # Not stored
+    def get_user_data(self):
+        return defaultdict(dict)
+
+    def get_chat_data(self):
+        return defaultdict(dict)
+
+    def get_conversations(self, name):
+        return {}
+
+    def update_conversation(self, name, key, new_state) -> None:
+        pass
+
+    def update_user_data(self, user_id, data) -> None:
+        pass
+
+    def update_chat_data(self, chat_id, data) -> None:
+        pass
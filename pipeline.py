@@ -0,0 +1,82 @@
+"""
+Staged processing for chat_polling
+
+Every text message used to go through every subsystem: the Kik style trigger check, trigger lookup, activity, the
+sass counter, the term tracker, reputation, character counters, question lookup and service message cleanup. Most
+messages are plain chatter that only needs activity and the counters.
+
+Now each message is classified once, up front, from the message alone (classify()), and the chat state the stages
+share (config, the current term) is worked out once into a MessageState. A Pipeline then runs only the stages whose
+condition holds for that message, in registration order, and times each one into metrics.STAGE_LATENCY (/stats
+and the benchmarks list them).
+"""
+
+import time
+
+import metrics
+
+
+class Classification:
+    """What kind of message this is, as far as the message itself can tell"""
+
+    __slots__ = ("reply_to_bot", "reply_to_user", "reputation_token", "has_separator", "candidate_trigger")
+
+    def __repr__(self):
+        return "Classification(" + ", ".join(name for name in self.__slots__ if getattr(self, name)) + ")"
+
+
+def classify(message, separator, reputation_tokens) -> Classification:
+    text = message.text or ""
+    replied_by = message.reply_to_message.from_user if message.reply_to_message else None
+    kind = Classification()
+    kind.reply_to_bot = replied_by is not None and replied_by.is_bot
+    kind.reply_to_user = replied_by is not None and not replied_by.is_bot
+    kind.reputation_token = text[:1] in reputation_tokens
+    kind.has_separator = separator in text
+    # Trigger words are saved from the text before the separator, so a message containing one can't be a trigger
+    kind.candidate_trigger = bool(text) and not kind.has_separator
+    return kind
+
+
+class MessageState:
+    """One message on its way through the pipeline. Stages read the chat state from here and leave results for later ones."""
+
+    def __init__(self, update, context, chat_id, chat_config, kind):
+        message = update.message
+        self.update = update
+        self.context = context
+        self.chat_id = chat_id
+        self.chat_config = chat_config
+        self.kind = kind
+        self.text = message.text
+        self.message_id = message.message_id
+        self.user_id = str(message.from_user.id)
+        self.username = message.from_user.username
+        # When Marvin handled it, a backlog after a restart shouldn't count as activity back then
+        self.timestamp = int(time.time())
+        # Set by the term stage when reputation is on
+        self.term_id = None
+
+
+class Pipeline:
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+
+    def register(self, name, run, when=None) -> None:
+        """run(state) for every message when is None, otherwise only for those when(state) is true for"""
+        self.stages.append((name, run, when))
+
+    def run(self, state) -> list:
+        """Runs the stages that apply, returns their names. An exception stops the rest, like it did in one handler."""
+        ran = []
+        for name, run, when in self.stages:
+            if when is not None and not when(state):
+                continue
+            start = time.perf_counter()
+            try:
+                run(state)
+            finally:
+                metrics.STAGE_LATENCY.observe((self.name, name), time.perf_counter() - start)
+            ran.append(name)
+        return ran
@@ -0,0 +1,92 @@
+"""
+Local user profiles so Marvin can mention people without asking Telegram who they are
+
+Every update already carries the sender's id, first/last name and username. ProfileStore keeps the latest of those
+in the user_profiles table (one row per Telegram user, names are the same in every chat) and renders mentions from
+it, so a message that mentions N people costs no get_chat_member calls.
+
+observe() is called for every incoming update. It compares against an in-memory copy first and only writes when
+something actually changed, so the steady state is a dict lookup per update.
+"""
+
+import logging
+import threading
+import time
+
+from telegram.utils.helpers import mention_markdown
+
+logger = logging.getLogger(__name__)
+
+# Most ids a single IN (...) lookup asks for, well under SQLite's variable limit
+LOOKUP_BATCH = 500
+
+
+def display_name(first_name, last_name, username, user_id) -> str:
+    """Same as telegram.User.full_name, falling back to the username and then the id for profiles we know little about"""
+    if first_name:
+        return first_name + " " + last_name if last_name else first_name
+    if username:
+        return username
+    return "User " + str(user_id)
+
+
+class ProfileStore:
+    """user_profiles with a write-through cache in front of it"""
+
+    def __init__(self, db):
+        self.db = db
+        # user_id -> (first_name, last_name, username), None for ids known not to have a row
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.writes = 0
+
+    def _fetch(self, user_ids) -> None:
+        """Loads the given ids into the cache, remembering the ones without a row"""
+        missing = [user_id for user_id in user_ids if user_id not in self._cache]
+        for start in range(0, len(missing), LOOKUP_BATCH):
+            batch = missing[start:start + LOOKUP_BATCH]
+            rows = self.db.execute(f"SELECT user_id, first_name, last_name, username FROM user_profiles WHERE user_id IN ({','.join('?' * len(batch))})", batch).fetchall()
+            found = {row[0]: (row[1], row[2], row[3]) for row in rows}
+            for user_id in batch:
+                self._cache[user_id] = found.get(user_id)
+
+    def observe(self, user) -> bool:
+        """Records a telegram.User seen on an update. Returns True when the stored profile had to change."""
+        if user is None:
+            return False
+        profile = (user.first_name, user.last_name, user.username)
+        with self._lock:
+            if user.id not in self._cache:
+                self._fetch([user.id])
+            if self._cache[user.id] == profile:
+                return False
+            self.db.execute("INSERT INTO user_profiles (user_id, first_name, last_name, username, updated) VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name, username = excluded.username, updated = excluded.updated", (user.id, *profile, int(time.time())))
+            self.db.commit()
+            self._cache[user.id] = profile
+            self.writes += 1
+        logger.debug("Profile for %s updated", user.id)
+        return True
+
+    def get(self, user_id):
+        """(first_name, last_name, username) or None if we've never seen them"""
+        user_id = int(user_id)
+        with self._lock:
+            if user_id not in self._cache:
+                self._fetch([user_id])
+            return self._cache[user_id]
+
+    def name(self, user_id) -> str:
+        profile = self.get(user_id) or (None, None, None)
+        return display_name(*profile, user_id)
+
+    def mention_markdown(self, user_id) -> str:
+        """Markdown (v1) mention, the same text telegram.User.mention_markdown() would give"""
+        return mention_markdown(int(user_id), self.name(user_id))
+
+    def mentions_markdown(self, user_ids) -> dict:
+        """user_id -> mention for a whole list of users, looked up in one go"""
+        user_ids = [int(user_id) for user_id in user_ids]
+        with self._lock:
+            self._fetch(user_ids)
+            profiles = {user_id: self._cache[user_id] or (None, None, None) for user_id in user_ids}
+        return {user_id: mention_markdown(user_id, display_name(*profile, user_id)) for user_id, profile in profiles.items()}
@@ -0,0 +1,55 @@
+"""
+In-memory token buckets for throttling things users can spam
+
+Each key (for reputation that's (chat_id, from_user_id) and (chat_id, from_user_id, to_user_id)) gets a bucket of
+capacity tokens that refills at capacity per window seconds. A bucket is just (tokens, last refill) in an LRU
+ordered dict capped at max_entries, the least recently used are dropped first. A dropped bucket comes back full,
+which only ever errs on the side of letting someone through.
+
+Limits are passed in on every call rather than fixed per key, so a chat changing its config takes effect on the
+next check without anything to invalidate.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Buckets kept before the least recently used are forgotten
+MAX_ENTRIES = 50000
+
+
+class TokenBuckets:
+    def __init__(self, max_entries=MAX_ENTRIES, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def _level(self, key, capacity, window, now) -> float:
+        tokens, last = self._buckets.get(key, (capacity, now))
+        return min(capacity, tokens + (now - last) * capacity / window)
+
+    def allow(self, limits) -> bool:
+        """
+        limits is a list of (key, capacity, window). Takes a token from every bucket if each has one, otherwise takes
+        nothing and returns False. A capacity or window of 0 means no limit for that key.
+        """
+        limits = [(key, capacity, window) for key, capacity, window in limits if capacity > 0 and window > 0]
+        if not limits:
+            return True
+        now = self.clock()
+        with self._lock:
+            levels = [self._level(key, capacity, window, now) for key, capacity, window in limits]
+            if any(level < 1 for level in levels):
+                self.rejected += 1
+                return False
+            for (key, capacity, window), level in zip(limits, levels):
+                self._buckets[key] = (level - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+        return True
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,314 @@
+"""
+Sharded mode: one router, N Marvin worker processes
+
+A single Marvin process runs every chat through one GIL and one SQLite writer. Sharded mode splits the chats over N
+worker processes instead. Each worker owns the chats with abs(chat_id) % N == k, has its own database file
+(marvin-shard-k-of-N.db), its own Updater, job queue and in-memory caches (pending questions, announcements, rate
+limit buckets), and never sees another shard's chats.
+
+The router is the only process talking to Telegram. It polls (or takes a webhook) and forwards each update to the
+owning worker over a multiprocessing queue as the update's JSON. Updates for one chat always land on the same
+worker in the order they arrived, so handlers see exactly what they would in a single process. Updates without a
+chat go by user, and anything with neither to shard 0.
+
+Commands that need every shard are answered by the router itself. It sends each worker a collect request, waits
+for all the replies and merges them:
+- /show_chats lists the chats from every shard's bot_data
+- /broadcast <text> has each shard send to its own groups and reports the combined count
+
+Usage:
+- python3 sharding.py split --shards 4        copies marvin.db into one database per shard, each keeping its own chats
+- python3 sharding.py run --shards 4          polls Telegram and runs 4 workers
+- python3 sharding.py run --shards 4 --webhook-url https://example.org/marvin --port 8443
+
+Changing the shard count means running split again from a single database, the shard files don't merge back.
+--shards 1 uses marvin.db itself and is the same as running MarvinBot.py.
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import Updater, CommandHandler, TypeHandler, DispatcherHandlerStop
+from decouple import config
+
+import logsetup
+import persistence
+
+logger = logging.getLogger(__name__)
+
+# How long the router waits on the workers for /show_chats and /broadcast, in seconds
+COLLECT_TIMEOUT = 30
+
+
+def shard_for(chat_id, shards) -> int:
+    """The shard that owns chat_id. Matches the abs(chat_id) % shards split applies to the database."""
+    return abs(int(chat_id)) % shards
+
+
+def route(update, shards) -> int:
+    if update.effective_chat is not None:
+        return shard_for(update.effective_chat.id, shards)
+    if update.effective_user is not None:
+        return shard_for(update.effective_user.id, shards)
+    return 0
+
+
+def shard_database(shard, shards) -> str:
+    """Database name (without .db) for a shard, a single shard keeps plain marvin"""
+    if shards == 1:
+        return "marvin"
+    return f"marvin-shard-{shard}-of-{shards}"
+
+
+def chats_text(username, lists) -> str:
+    """The /show_chats reply for the lists from MarvinBot.chat_lists(), or several of them merged"""
+    user_ids = ", ".join(str(uid) for uid in lists["user_ids"])
+    group_ids = ", ".join(str(gid) for gid in lists["group_ids"])
+    channel_ids = ", ".join(str(cid) for cid in lists["channel_ids"])
+    return (
+        f"@{username} is currently in a conversation with the user IDs {user_ids}."
+        f" Moreover it is a member of the groups with IDs {group_ids} "
+        f"and administrator in the channels with IDs {channel_ids}."
+    )
+
+
+def serve(dispatcher, inbox, outbox, shard, collectors) -> int:
+    """
+    A worker's main loop. Messages on the inbox are:
+    - ("update", json) processed by the dispatcher
+    - ("collect", request_id, name, args) answered on the outbox with (request_id, shard, collectors[name](*args)),
+      "handled" is always there and returns how many updates this worker has processed
+    - ("stop",) returns the number of updates handled
+    """
+    handled = 0
+    while True:
+        message = inbox.get()
+        if message[0] == "update":
+            dispatcher.process_update(Update.de_json(json.loads(message[1]), dispatcher.bot))
+            handled += 1
+        elif message[0] == "collect":
+            _, request_id, name, args = message
+            try:
+                result = handled if name == "handled" else collectors[name](*args)
+            except Exception:
+                logger.exception("Shard %d failed to collect %s", shard, name)
+                result = None
+            outbox.put((request_id, shard, result))
+        elif message[0] == "stop":
+            return handled
+
+
+def worker_main(shard, shards, inbox, outbox) -> None:
+    """Entry point of a worker process, runs Marvin on this shard's database until the router says stop"""
+    # The router handles Ctrl-C and tells the workers to stop once it has stopped taking updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["MARVIN_DB"] = shard_database(shard, shards)
+    import MarvinBot
+    from telegram.utils.request import Request
+
+    bot = MarvinBot.metrics.InstrumentedBot(MarvinBot.TOKEN, request=Request(con_pool_size=8))
+    updater = MarvinBot.build_updater(bot)
+    if MarvinBot.METRICS_PORT:
+        # One port per shard, counting up from METRICS_PORT
+        MarvinBot.metrics.start_http_server(MarvinBot.METRICS_PORT + shard, MarvinBot.METRICS_HOST)
+    MarvinBot.warm_start(bot)
+    updater.job_queue.start()
+    dispatcher = updater.dispatcher
+    collectors = {
+        "chats": lambda: MarvinBot.chat_lists(dispatcher.bot_data),
+        "broadcast": lambda text: MarvinBot.broadcast_to_groups(bot, dispatcher.bot_data, text),
+    }
+    logger.info("Shard %d of %d serving %s.db", shard, shards, MarvinBot.dbname)
+    try:
+        handled = serve(dispatcher, inbox, outbox, shard, collectors)
+    finally:
+        updater.job_queue.stop()
+        MarvinBot.shutdown.drain()
+    logger.info("Shard %d stopped after %d updates", shard, handled)
+
+
+class Router:
+    """Starts the workers and talks to them. target(shard, shards, inbox, outbox, *args) runs in each process."""
+
+    def __init__(self, shards, target=worker_main, args=()):
+        self.shards = shards
+        context = multiprocessing.get_context("spawn")
+        self.inboxes = [context.Queue() for _ in range(shards)]
+        self.outbox = context.Queue()
+        self.processes = [
+            context.Process(target=target, args=(shard, shards, self.inboxes[shard], self.outbox) + tuple(args), name=f"marvin-shard-{shard}", daemon=True)
+            for shard in range(shards)
+        ]
+        self._request_ids = itertools.count(1)
+        self._collect_lock = threading.Lock()
+
+    def start(self) -> None:
+        for process in self.processes:
+            process.start()
+
+    def forward(self, update) -> int:
+        shard = route(update, self.shards)
+        self.inboxes[shard].put(("update", update.to_json()))
+        return shard
+
+    def forward_json(self, shard, data) -> None:
+        self.inboxes[shard].put(("update", json.dumps(data)))
+
+    def collect(self, name, *args, timeout=COLLECT_TIMEOUT) -> list:
+        """Asks every shard for name(*args). Returns the results by shard, None for a shard that didn't answer in time."""
+        with self._collect_lock:
+            request_id = next(self._request_ids)
+            for inbox in self.inboxes:
+                inbox.put(("collect", request_id, name, args))
+            results = [None] * self.shards
+            waiting = set(range(self.shards))
+            deadline = time.monotonic() + timeout
+            while waiting:
+                try:
+                    reply_id, shard, result = self.outbox.get(timeout=1)
+                except queue.Empty:
+                    # A worker that has died is never going to answer
+                    if time.monotonic() < deadline and all(self.processes[shard].is_alive() for shard in waiting):
+                        continue
+                    logger.warning("Shards %s didn't answer %s", sorted(waiting), name)
+                    break
+                # Answers to an earlier request that timed out are dropped
+                if reply_id == request_id:
+                    results[shard] = result
+                    waiting.discard(shard)
+            return results
+
+    def stop(self, timeout=30) -> None:
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.warning("%s didn't stop in time, terminating it", process.name)
+                process.terminate()
+
+
+def merge_chat_lists(results) -> dict:
+    merged = {"user_ids": [], "group_ids": [], "channel_ids": []}
+    for lists in results:
+        for key in merged:
+            merged[key].extend((lists or {}).get(key, ()))
+    return {key: sorted(set(ids)) for key, ids in merged.items()}
+
+
+def run(args) -> None:
+    log_setup = logsetup.setup_logging(level=getattr(logging, config('LOG_LEVEL', default='INFO').upper(), logging.INFO), json_format=config('LOG_FORMAT', default='text').lower() == 'json')
+    owner = config('OWNER', default=0, cast=int)
+    router = Router(args.shards)
+    router.start()
+
+    def is_owner(update) -> bool:
+        return owner != 0 and update.effective_user is not None and update.effective_user.id == owner
+
+    def show_chats(update, context) -> None:
+        update.effective_message.reply_text(chats_text(context.bot.username, merge_chat_lists(router.collect("chats"))))
+        raise DispatcherHandlerStop()
+
+    def broadcast(update, context) -> None:
+        chat_id = update.effective_message.chat_id
+        command = update.effective_message.text.split(' ', 1)
+        if not is_owner(update):
+            context.bot.send_message(chat_id, text="Sorry /broadcast is for my owner only.")
+        elif len(command) == 1 or not command[1].strip():
+            context.bot.send_message(chat_id, text="No text provided!")
+        else:
+            results = [result or (0, 0) for result in router.collect("broadcast", command[1])]
+            context.bot.send_message(chat_id, text='Broadcast sent to {} groups of {}'.format(sum(sent for sent, _ in results), sum(total for _, total in results)))
+        raise DispatcherHandlerStop()
+
+    def forward(update, context) -> None:
+        router.forward(update)
+
+    updater = Updater(config('TOKEN'))
+    updater.dispatcher.add_handler(CommandHandler("show_chats", show_chats))
+    updater.dispatcher.add_handler(CommandHandler("broadcast", broadcast))
+    updater.dispatcher.add_handler(TypeHandler(Update, forward), group=1)
+
+    if args.webhook_url:
+        updater.start_webhook(listen=args.listen, port=args.port, url_path=args.url_path, webhook_url=args.webhook_url, allowed_updates=Update.ALL_TYPES)
+    else:
+        updater.start_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Routing updates to %d shards", args.shards)
+    try:
+        updater.idle()
+    finally:
+        # The updater has stopped fetching, whatever is queued still gets processed before the workers exit
+        router.stop()
+        log_setup.stop()
+
+
+def split(args) -> None:
+    """Copies the source database once per shard and deletes the chats each shard doesn't own"""
+    source = args.database
+    if not os.path.exists(source):
+        raise SystemExit(f"{source} not found")
+    for shard in range(args.shards):
+        target = shard_database(shard, args.shards) + ".db"
+        if os.path.abspath(target) == os.path.abspath(source):
+            raise SystemExit("Splitting into a single shard would overwrite the source, there's nothing to do")
+        if os.path.exists(target) and not args.force:
+            raise SystemExit(f"{target} already exists, use --force to replace it")
+        shutil.copy(source, target)
+        db = sqlite3.connect(target)
+        tables = [row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        removed = 0
+        for table in tables:
+            columns = [row[1] for row in db.execute(f"PRAGMA table_info('{table}')")]
+            if "chat_id" in columns:
+                removed += db.execute(f"DELETE FROM '{table}' WHERE abs(chat_id) % ? != ?", (args.shards, shard)).rowcount
+        # The chat lists in bot_data are split the same way, anything else there is copied as is
+        if "bot_data" in tables:
+            for key, raw in db.execute("SELECT data_key, data_value FROM bot_data").fetchall():
+                value = persistence.decode(raw)
+                if key in ("user_ids", "group_ids", "channel_ids") and isinstance(value, set):
+                    value = {chat_id for chat_id in value if shard_for(chat_id, args.shards) == shard}
+                    db.execute("UPDATE bot_data SET data_value = ? WHERE data_key = ?", (persistence.encode(value), key))
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+        print(f"{target}: removed {removed} rows belonging to other shards")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Route updates to N worker processes")
+    run_parser.add_argument("--shards", type=int, default=config('SHARDS', default=2, cast=int))
+    run_parser.add_argument("--webhook-url", help="Take updates on a webhook at this public URL instead of polling")
+    run_parser.add_argument("--listen", default="127.0.0.1", help="Address the webhook server binds to")
+    run_parser.add_argument("--port", type=int, default=8443, help="Port the webhook server binds to")
+    run_parser.add_argument("--url-path", default="", help="Path the webhook is served on")
+
+    split_parser = commands.add_parser("split", help="Copy a database into one per shard")
+    split_parser.add_argument("--shards", type=int, required=True)
+    split_parser.add_argument("--database", default="marvin.db", help="Database to split")
+    split_parser.add_argument("--force", action="store_true", help="Replace shard databases that already exist")
+
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.command == "run":
+        run(args)
+    else:
+        split(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Opt-in SQL profiler for Marvin's global cursor
+
+ProfilingCursor sits in front of the module level cursor in MarvinBot.py and times every statement,
+including the fetch that follows it. Timings are aggregated by normalised SQL text (literals and IN lists
+collapsed) so the same query with different parameters lands in one bucket. Statements slower than the
+threshold are logged with their parameters.
+
+explain_top() runs EXPLAIN QUERY PLAN for the worst offenders using the last parameters seen for each,
+which is the quickest way to prove whether a query is scanning a table that needs an index.
+
+Enable with SQL_PROFILE=True in .env, SQL_SLOW_MS sets the slow query threshold.
+"""
+
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+WHITESPACE = re.compile(r"\s+")
+
+# Only data statements have a query plan worth looking at
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+def normalise(sql) -> str:
+    """Collapse whitespace, literals and IN lists so queries differing only by values aggregate together"""
+    sql = STRING_LITERAL.sub("?", sql)
+    sql = NUMBER_LITERAL.sub("?", sql)
+    sql = IN_LIST.sub("IN (...)", sql)
+    return WHITESPACE.sub(" ", sql).strip().rstrip(";")
+
+
+class QueryStats:
+    __slots__ = ("calls", "total", "worst", "rows", "last_sql", "last_params")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.rows = 0
+        self.last_sql = None
+        self.last_params = ()
+
+
+class SQLProfiler:
+    """Aggregated timings per normalised statement. Shared by every ProfilingCursor on a connection."""
+
+    def __init__(self, slow_threshold_ms=50.0):
+        self.slow_threshold = slow_threshold_ms / 1000.0
+        self.queries = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql, params, elapsed, rows=0) -> None:
+        key = normalise(sql)
+        with self._lock:
+            stats = self.queries.get(key)
+            if stats is None:
+                stats = self.queries[key] = QueryStats()
+            stats.calls += 1
+            stats.total += elapsed
+            stats.rows += rows
+            if elapsed > stats.worst:
+                stats.worst = elapsed
+            stats.last_sql = sql
+            stats.last_params = params
+
+    def add_fetch(self, sql, elapsed, rows) -> None:
+        # Fetch time belongs to the statement that produced the rows
+        key = normalise(sql)
+        with self._lock:
+            stats = self.queries.get(key)
+            if stats is not None:
+                stats.total += elapsed
+                stats.rows += rows
+
+    def check_slow(self, sql, params, elapsed) -> None:
+        if elapsed >= self.slow_threshold:
+            logger.warning("Slow query %.1fms: %s params=%r", elapsed * 1000, WHITESPACE.sub(" ", sql).strip(), params)
+
+    def top(self, limit=10, key="total") -> list:
+        """[(normalised_sql, QueryStats)] sorted by total time (or calls/worst)"""
+        with self._lock:
+            items = list(self.queries.items())
+        items.sort(key=lambda item: getattr(item[1], key), reverse=True)
+        return items[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self.queries.clear()
+
+    def report(self, limit=10) -> str:
+        lines = [f"{'calls':>8} {'total ms':>10} {'mean ms':>8} {'worst ms':>9} {'rows':>8}  statement"]
+        for sql, stats in self.top(limit):
+            lines.append(f"{stats.calls:>8} {stats.total * 1000:>10.1f} {stats.total * 1000 / stats.calls:>8.2f} {stats.worst * 1000:>9.2f} {stats.rows:>8}  {sql}")
+        return "\n".join(lines)
+
+    def explain_top(self, db, limit=5) -> list:
+        """[(normalised_sql, [plan lines])] for the most expensive explainable statements"""
+        plans = []
+        for sql, stats in self.top(limit * 3):
+            if not sql.split(" ", 1)[0].upper() in EXPLAINABLE or stats.last_sql is None:
+                continue
+            try:
+                rows = db.execute("EXPLAIN QUERY PLAN " + stats.last_sql, stats.last_params).fetchall()
+                plan = [str(row[3]) for row in rows]
+            except Exception as ex:
+                plan = ["EXPLAIN failed: " + str(ex)]
+            plans.append((sql, plan))
+            if len(plans) == limit:
+                break
+        return plans
+
+    def explain_report(self, db, limit=5) -> str:
+        lines = []
+        for sql, plan in self.explain_top(db, limit):
+            lines.append(sql)
+            lines.extend("    " + step for step in plan)
+            lines.append("")
+        return "\n".join(lines)
+
+
+class ProfilingCursor:
+    """Drop-in wrapper for sqlite3.Cursor. execute() returns the wrapper so 'select = cursor.execute(...)' keeps working."""
+
+    def __init__(self, cursor, profiler):
+        self._cursor = cursor
+        self._profiler = profiler
+        self._last_sql = None
+
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(sql, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._profiler.record(sql, params, elapsed)
+            self._profiler.check_slow(sql, params, elapsed)
+            self._last_sql = sql
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        start = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            elapsed = time.perf_counter() - start
+            self._profiler.record(sql, seq_of_params[-1] if seq_of_params else (), elapsed)
+            self._profiler.check_slow(sql, "<%d rows>" % len(seq_of_params), elapsed)
+            self._last_sql = sql
+        return self
+
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        result = fetch(*args)
+        if self._last_sql is not None:
+            rows = len(result) if isinstance(result, list) else int(result is not None)
+            self._profiler.add_fetch(self._last_sql, time.perf_counter() - start, rows)
+        return result
+
+    def fetchone(self):
+        return self._timed_fetch(self._cursor.fetchone)
+
+    def fetchall(self):
+        return self._timed_fetch(self._cursor.fetchall)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(self._cursor.fetchmany, size or self._cursor.arraysize)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        # rowcount, lastrowid, description etc
+        return getattr(self._cursor, name)
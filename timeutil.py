@@ -0,0 +1,38 @@
+"""
+Times as Marvin stores them
+
+Every time column in marvin.db holds whole seconds since the Unix epoch. They compare as plain integers, so range
+queries go through an index without converting anything per row, and an instant means the same thing whatever
+timezone or DST offset the server happens to be in. Turning one into something readable only happens when a
+message is written, with the helpers below.
+"""
+
+import time
+from datetime import datetime
+
+# What the time columns held before migration 5, local time
+LEGACY_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def now() -> int:
+    return int(time.time())
+
+
+def from_legacy(text) -> int:
+    """Epoch seconds for an old '%Y-%m-%d %H:%M:%S' local time string"""
+    return int(datetime.strptime(text, LEGACY_FORMAT).timestamp())
+
+
+def local(epoch) -> datetime:
+    """Naive local datetime, what pretty_date() and friends compare against datetime.now()"""
+    return datetime.fromtimestamp(int(epoch))
+
+
+def date_text(epoch) -> str:
+    """YYYY-MM-DD in local time"""
+    return local(epoch).strftime('%Y-%m-%d')
+
+
+def datetime_text(epoch) -> str:
+    """YYYY-MM-DD HH:MM:SS in local time"""
+    return local(epoch).strftime(LEGACY_FORMAT)